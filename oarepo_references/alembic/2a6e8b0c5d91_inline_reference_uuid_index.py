@@ -0,0 +1,30 @@
+#
+# This file is part of Invenio.
+# Copyright (C) 2016-2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Add partial index of inlined references by UUID."""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '2a6e8b0c5d91'
+down_revision = 'f1b7d9e2a4c8'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    op.create_index('ix_oarepo_references_inline_reference_uuid', 'oarepo_references', ['reference_uuid'],
+                    unique=False,
+                    postgresql_where=sa.text('inline IS true'),
+                    sqlite_where=sa.text('inline IS 1'))
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_index('ix_oarepo_references_inline_reference_uuid', table_name='oarepo_references')
@@ -0,0 +1,28 @@
+#
+# This file is part of Invenio.
+# Copyright (C) 2016-2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Add reference index usable by prefix lookups."""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5b0d2e7f9a13'
+down_revision = '2a6e8b0c5d91'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    op.create_index('ix_oarepo_references_reference_pattern', 'oarepo_references', ['reference'],
+                    unique=False,
+                    postgresql_ops={'reference': 'varchar_pattern_ops'})
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_index('ix_oarepo_references_reference_pattern', table_name='oarepo_references')
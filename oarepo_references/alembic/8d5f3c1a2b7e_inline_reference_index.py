@@ -0,0 +1,30 @@
+#
+# This file is part of Invenio.
+# Copyright (C) 2016-2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Add partial index of inlined references."""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '8d5f3c1a2b7e'
+down_revision = '41961e82e345'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    op.create_index('ix_oarepo_references_inline_reference', 'oarepo_references', ['reference'],
+                    unique=False,
+                    postgresql_where=sa.text('inline IS true'),
+                    sqlite_where=sa.text('inline IS 1'))
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_index('ix_oarepo_references_inline_reference', table_name='oarepo_references')
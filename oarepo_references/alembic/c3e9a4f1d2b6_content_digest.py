@@ -0,0 +1,29 @@
+#
+# This file is part of Invenio.
+# Copyright (C) 2016-2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Added content digest of inlined references."""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c3e9a4f1d2b6'
+down_revision = '8d5f3c1a2b7e'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    op.add_column('oarepo_references', sa.Column('content_digest', sa.String(length=64), nullable=True))
+    op.add_column('oarepo_references_version', sa.Column('content_digest', sa.String(length=64), autoincrement=False, nullable=True))
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_column('oarepo_references_version', 'content_digest')
+    op.drop_column('oarepo_references', 'content_digest')
@@ -0,0 +1,32 @@
+#
+# This file is part of Invenio.
+# Copyright (C) 2016-2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Added JSON paths of references."""
+
+import sqlalchemy as sa
+import sqlalchemy_utils
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'f1b7d9e2a4c8'
+down_revision = 'c3e9a4f1d2b6'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    json_type = sa.JSON().with_variant(sqlalchemy_utils.types.JSONType(), 'sqlite') \
+        .with_variant(sqlalchemy_utils.types.JSONType(), 'mysql')
+    op.add_column('oarepo_references', sa.Column('json_paths', json_type, nullable=True))
+    op.add_column('oarepo_references_version', sa.Column('json_paths', json_type, autoincrement=False, nullable=True))
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_column('oarepo_references_version', 'json_paths')
+    op.drop_column('oarepo_references', 'json_paths')
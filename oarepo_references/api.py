@@ -9,19 +9,34 @@
 
 from __future__ import absolute_import, print_function
 
+import json
+import logging
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from elasticsearch.helpers import bulk
+from flask import current_app
+from invenio_base.utils import obj_or_import_string
 from invenio_db import db
 from invenio_indexer.api import RecordIndexer
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus
 from invenio_records import Record
 from invenio_records.models import RecordMetadata
-from invenio_search import current_search_client
+from sqlalchemy import String, and_, exists, func, literal, or_
+from sqlalchemy.orm import joinedload
+from werkzeug.local import LocalProxy
 
+from oarepo_references.indexing import defer_reindex
 from oarepo_references.mixins import ReferenceEnabledRecordMixin
-from oarepo_references.models import RecordReference, ReferencingRecord
+from oarepo_references.models import ClassName, RecordReference, \
+    ReferencingRecord
+from oarepo_references.propagation import ReferencePropagation
+from oarepo_references.proxies import current_references
 from oarepo_references.signals import after_reference_update
-from oarepo_references.utils import get_record_object
 
-# import logging
-# log = logging.getLogger(__name__)
+log = logging.getLogger(__name__)
+
 
 class RecordReferenceAPI(object):
     """Represent a record reference."""
@@ -29,61 +44,207 @@ class RecordReferenceAPI(object):
     indexer_version_type = None
 
     @classmethod
-    def reference_content_changed(cls, ref_obj, ref_url=None, ref_uuid=None):
+    def reference_content_changed(cls, ref_obj, ref_url=None, ref_uuid=None, max_depth=None,
+                                  commit=False):
         """Find & update records that have inlined the changed reference.
 
+        Referencing records are looked up by the reference UUID when it is given,
+        and by the reference URI. The change is propagated transitively to records inlining
+        the updated records as well, each affected record is committed once.
+
         :param ref_obj: Changed reference content data
         :param ref_url: Reference URI
         :param ref_uuid: UUID of referenced Record
-        :returns A list of Records affected by change and updated
+        :param max_depth: Maximal propagation depth, defaults to
+                          ``OAREPO_REFERENCES_PROPAGATION_MAX_DEPTH``
+        :param commit: commit the database transaction after every chunk of updated records
+        :returns A list of Records affected by change and updated,
+                 a list of their UUIDs with ``commit``
         """
         assert ref_url or ref_uuid, 'Reference URL or UUID must be provided'
 
-        updated = []
-        records_to_update = cls.get_records(ref_url, exact=True)
-        found_records_to_update = []
-        for r in records_to_update:
-            rec = get_record_object(r)
-            if isinstance(rec, ReferenceEnabledRecordMixin):
-                found_records_to_update.append((r, rec))
-
-        rec_ids = [r[1].id for r in found_records_to_update]
-        # log.error('References: locking %s', [str(x) for x in rec_ids])
-        locked = list(
-            RecordMetadata.query.filter(RecordMetadata.id.in_(rec_ids)).with_for_update()
-        )
-        # log.error('References: locked %s', rec_ids)
-
-        for r, rec in found_records_to_update:
-            # reload the record from the database ... invenio does not have support for this,
-            # do it the slow way
-            rec_id = rec.id
-            db.session.expire(rec.model)
-            rec = type(rec).get_record(rec_id)
-            # log.error('References: loaded locked %s: %s', rec.id, rec.model.version_id)
-            rec.update_inlined_ref(ref_url, ref_uuid, ref_obj)
-            updated.append(rec)
+        return cls.reference_content_changed_many(
+            [{'content': ref_obj, 'url': ref_url, 'uuid': ref_uuid}], max_depth=max_depth,
+            commit=commit)
 
-        return updated
+    @classmethod
+    def reference_content_changed_many(cls, changes, max_depth=None, commit=False):
+        """Find & update records that have inlined any of the changed references.
+
+        Changes are inverted into per-referrer sets of changes, so that a record
+        inlining several of the changed references (e.g. after a vocabulary reload)
+        is locked, revalidated and committed once with all of them. The changed
+        references themselves are not updated, even if they inline each other.
+
+        Records are locked and updated in chunks of ``OAREPO_REFERENCES_LOCK_CHUNK_SIZE``.
+        With ``commit``, the database transaction is committed after every chunk,
+        so that neither the locks nor the updated records are held until all
+        the referrers have been updated.
+
+        :param changes: An iterable of dicts with the changed ``content`` and
+                        the reference ``url`` and/or the ``uuid`` of a referenced Record
+        :param max_depth: Maximal propagation depth, defaults to
+                          ``OAREPO_REFERENCES_PROPAGATION_MAX_DEPTH``
+        :param commit: commit the database transaction after every chunk of updated records
+        :returns A list of Records affected by changes and updated,
+                 a list of their UUIDs with ``commit``
+        """
+        changes = list(changes)
+        for change in changes:
+            assert change.get('url') or change.get('uuid'), \
+                'Reference URL or UUID must be provided'
+        if not changes:
+            return []
+
+        if max_depth is None:
+            max_depth = current_app.config['OAREPO_REFERENCES_PROPAGATION_MAX_DEPTH']
+
+        return ReferencePropagation(
+            cls, changes, max_depth=max_depth,
+            patch=current_app.config['OAREPO_REFERENCES_PATCH_INLINED'], commit=commit).run()
 
     @classmethod
-    def reference_changed(cls, old, new):
+    def reference_changed(cls, old, new, bulk=False, prefix=False):
         """Find & update records that have referenced the changed reference.
 
+        In the bulk mode, stored link references are renamed by a single SQL statement
+        first and the records holding them are then rewritten in locked chunks,
+        see :meth:`rename_references` and :meth:`rewrite_renamed_references`.
+
         :param old: Old Reference URI
         :param new: New Reference URI
+        :param bulk: rename stored references by a single SQL statement
+        :param prefix: rename all references starting with ``old`` (bulk mode only)
         :returns: A list of Records affected by change and updated
+        :raises ValueError: if a prefix rename is requested outside of the bulk mode
         """
+        if prefix and not bulk:
+            raise ValueError('Prefix renames are supported in the bulk mode only')
+
         updated = []
-        records_to_update = cls.get_records(old, exact=True)
-        for r in records_to_update:
-            rec = get_record_object(r)
-            if isinstance(rec, ReferenceEnabledRecordMixin):
+        if bulk:
+            cls.rename_references(old, new, prefix=prefix)
+            for _, records in cls.rewrite_renamed_references(old, new, prefix=prefix):
+                updated.extend(records)
+            return updated
+
+        for refs in cls.iter_records(old, exact=True):
+            for rec in cls.lock_referrers(cls.group_by_class(refs)):
                 rec.update_ref(old, new)
                 updated.append(rec)
 
         return updated
 
+    @classmethod
+    def _renamed_reference(cls, table, old, new, prefix):
+        """Return a condition matching link references to be renamed and their new value."""
+        # inlined references are updated when the changed content of the renamed
+        # record is propagated, the rewrite of referencing records does not rename them
+        match = table.c.inline.is_(False)
+        if not prefix:
+            return and_(match, table.c.reference == old), literal(new, String)
+        match = and_(match, table.c.reference.startswith(old, autoescape=True))
+        if new.startswith(old):
+            # references that already have the new prefix have been renamed before
+            match = and_(match, ~table.c.reference.startswith(new, autoescape=True))
+        return match, literal(new, String) + func.substr(table.c.reference, len(old) + 1)
+
+    @classmethod
+    def rename_references(cls, old, new, prefix=False):
+        """Rename stored link references by a single SQL UPDATE.
+
+        A reference is dropped instead if its referencing record already
+        references the new URI. Running the rename again is a no-op.
+
+        .. note::
+
+           Only the references table is updated, use :meth:`rewrite_renamed_references`
+           to rewrite the referencing records.
+
+        :param old: Old Reference URI (or its prefix)
+        :param new: New Reference URI (or its prefix)
+        :param prefix: rename all references starting with ``old``
+        :returns: number of ReferencingRecords whose references have been renamed
+        """
+        table = RecordReference.__table__
+        other = table.alias('other')
+        match, renamed = cls._renamed_reference(table, old, new, prefix)
+        count = db.session.query(func.count(table.c.record_id.distinct())).filter(match).scalar()
+        if not count:
+            return 0
+
+        # only references loaded in the session need to be expired, not all the renamed ones
+        loaded_ids = set()
+        for obj in db.session.identity_map.values():
+            if isinstance(obj, ReferencingRecord):
+                loaded_ids.add(obj.__dict__.get('id'))
+            elif isinstance(obj, RecordReference):
+                loaded_ids.add(obj.__dict__.get('record_id'))
+        loaded_ids.discard(None)
+        duplicate = exists().where(and_(other.c.record_id == table.c.record_id,
+                                        other.c.reference == renamed))
+        record_ids, deleted_ids = [], []
+        if loaded_ids:
+            loaded = and_(match, table.c.record_id.in_(loaded_ids))
+            record_ids = [v for v, in db.session.query(table.c.record_id).filter(loaded)]
+            deleted_ids = [v for v, in db.session.query(table.c.id)
+                           .filter(and_(loaded, duplicate))]
+
+        db.session.execute(table.delete().where(and_(match, duplicate)))
+        db.session.execute(
+            table.update().where(match).values(reference=renamed,
+                                               version_id=table.c.version_id + 1))
+        RecordReference.expire_loaded_references(record_ids, deleted_ids)
+        return count
+
+    @classmethod
+    def rewrite_renamed_references(cls, old, new, prefix=False, after=None, chunk_size=None):
+        """Rewrite references in records referencing a renamed reference.
+
+        Renamed references can not be told apart from the ones stored with the new URI
+        before, so all records having a link reference to ``new`` (or starting with it)
+        are locked and those still containing ``old`` are rewritten. The records are found
+        chunk by chunk by keyset pagination on the id of their ReferencingRecord. Records
+        of a chunk are rewritten and yielded together, so the caller can commit after each
+        chunk and resume after its last id.
+
+        :param old: Old Reference URI (or its prefix)
+        :param new: New Reference URI (or its prefix)
+        :param prefix: rewrite all references starting with ``old``
+        :param after: ReferencingRecord id of the last record processed before
+        :param chunk_size: number of records in a chunk,
+                           defaults to ``OAREPO_REFERENCES_LOCK_CHUNK_SIZE``
+        :returns: a generator of (last ReferencingRecord id, rewritten records) tuples
+        """
+        chunk_size = chunk_size or current_app.config['OAREPO_REFERENCES_LOCK_CHUNK_SIZE']
+        if prefix:
+            match = RecordReference.reference.startswith(new, autoescape=True)
+        else:
+            match = RecordReference.reference == new
+        query = db.session.query(ReferencingRecord.id, ReferencingRecord.class_id,
+                                 ReferencingRecord.record_uuid) \
+            .filter(exists().where(and_(RecordReference.record_id == ReferencingRecord.id,
+                                        RecordReference.inline.is_(False),
+                                        match))) \
+            .order_by(ReferencingRecord.id)
+        while True:
+            rows = (query.filter(ReferencingRecord.id > after) if after is not None else query) \
+                .limit(chunk_size).all()
+            if not rows:
+                break
+            after = rows[-1].id
+            referrers = defaultdict(list)
+            for _, class_id, record_uuid in rows:
+                referrers[class_id].append(record_uuid)
+            records = []
+            for rec in cls.lock_referrers(referrers):
+                # records that have referenced the new URI only are left as they are
+                if old not in json.dumps(rec):
+                    continue
+                rec.update_ref(old, new, prefix=prefix)
+                records.append(rec)
+            yield after, records
+
     @classmethod
     def get_records(cls, reference, exact=False):
         """Retrieve multiple reference records by reference.
@@ -98,10 +259,225 @@ class RecordReferenceAPI(object):
                     .filter(RecordReference.reference == reference)
             else:
                 query = RecordReference.query \
-                    .filter(RecordReference.reference.startswith(reference))
+                    .filter(cls.reference_prefix_filter(reference))
+
+        return query.all()
+
+    @classmethod
+    def iter_records(cls, reference, exact=False, inline=None, chunk_size=None, after=None):
+        """Iterate reference records by reference, chunk by chunk.
+
+        Chunks are fetched by keyset pagination on the reference record id,
+        so the memory needed does not depend on the number of referencing records.
+
+        :param reference: Reference URI
+        :param exact: match the whole reference URI instead of its prefix
+        :param inline: if set, iterate only references (not) inlining the referenced object
+        :param chunk_size: number of reference records in a chunk,
+                           defaults to ``OAREPO_REFERENCES_CHUNK_SIZE``
+        :param after: id of the reference record to continue after, e.g. the last one
+                      of a chunk iterated before
+        :returns: A generator of lists of :class:`oarepo_references.models.RecordReference`
+                  instances containing the reference.
+        """
+        chunk_size = chunk_size or current_app.config['OAREPO_REFERENCES_CHUNK_SIZE']
+
+        query = RecordReference.query.options(joinedload(RecordReference.record))
+        if exact:
+            query = query.filter(RecordReference.reference == reference)
+        else:
+            query = query.filter(cls.reference_prefix_filter(reference))
+        if inline is not None:
+            query = query.filter(RecordReference.inline.is_(inline))
+        query = query.order_by(RecordReference.id)
+
+        last_id = after
+        while True:
+            chunk_query = query
+            if last_id is not None:
+                chunk_query = chunk_query.filter(RecordReference.id > last_id)
+            chunk = chunk_query.limit(chunk_size).all()
+            if not chunk:
+                return
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+            last_id = chunk[-1].id
+
+    @classmethod
+    def group_by_class(cls, refs):
+        """Group referencing records of reference records by their class.
+
+        :param refs: An iterable of :class:`oarepo_references.models.RecordReference`
+        :returns: A dict mapping :class:`oarepo_references.models.ClassName` ids
+                  to lists of referencing record UUIDs.
+        """
+        referrers = defaultdict(list)
+        for ref in refs:
+            referrers[ref.record.class_id].append(ref.record.record_uuid)
+        return referrers
+
+    @classmethod
+    def reference_prefix_filter(cls, prefix):
+        """Return a filter matching references starting with a prefix.
+
+        Wildcard characters in the prefix are escaped, so the resulting ``LIKE 'prefix%'``
+        can be served by the ``varchar_pattern_ops`` index of the reference column.
+
+        :param prefix: Reference URI prefix
+        """
+        return RecordReference.reference.startswith(prefix, autoescape=True)
+
+    @classmethod
+    def get_records_by_uuid(cls, reference_uuid):
+        """Retrieve multiple reference records by UUID of the referenced record.
+
+        :param reference_uuid: UUID of the referenced record
+        :returns: A list of :class:`oarepo_references.models.RecordReference`
+                  instances containing the reference.
+        """
+        with db.session.no_autoflush:
+            query = RecordReference.query \
+                .filter(RecordReference.reference_uuid == reference_uuid)
 
         return query.all()
 
+    @classmethod
+    def get_referrer_ids_by_class(cls, reference, exact=False, inline=None):
+        """Retrieve UUIDs of records referencing a reference, grouped by their class.
+
+        :param reference: Reference URI
+        :param exact: match the whole reference URI instead of its prefix
+        :param inline: if set, return only records (not) inlining the reference
+        :returns: A dict mapping :class:`oarepo_references.models.ClassName` ids
+                  to lists of referencing record UUIDs.
+        """
+        query = db.session.query(ReferencingRecord.class_id, ReferencingRecord.record_uuid) \
+            .join(RecordReference, RecordReference.record_id == ReferencingRecord.id)
+        if exact:
+            query = query.filter(RecordReference.reference == reference)
+        else:
+            query = query.filter(cls.reference_prefix_filter(reference))
+        if inline is not None:
+            query = query.filter(RecordReference.inline.is_(inline))
+
+        referrers = defaultdict(list)
+        for class_id, record_uuid in query.distinct():
+            referrers[class_id].append(record_uuid)
+        return referrers
+
+    @classmethod
+    def iter_referrers(cls, references=(), inline=None, reference_uuids=(), chunk_size=None):
+        """Iterate records referencing any of the given references, chunk by chunk.
+
+        Chunks are fetched by keyset pagination on the reference record id,
+        so the memory needed does not depend on the number of referrers.
+
+        :param references: An iterable of reference URIs
+        :param inline: if set, return only records (not) inlining the references
+        :param reference_uuids: An iterable of UUIDs of referenced records
+        :param chunk_size: number of rows in a chunk,
+                           defaults to ``OAREPO_REFERENCES_CHUNK_SIZE``
+        :returns: A generator of lists of rows with ``id`` (reference record id),
+                  ``reference``, ``reference_uuid``, ``content_digest``, ``json_paths``,
+                  ``class_id`` (ClassName id) and ``record_uuid`` (referencing record UUID)
+                  columns
+        """
+        conditions = []
+        references = list(references)
+        if references:
+            conditions.append(RecordReference.reference.in_(references))
+        reference_uuids = list(reference_uuids)
+        if reference_uuids:
+            conditions.append(RecordReference.reference_uuid.in_(reference_uuids))
+        if not conditions:
+            return
+
+        chunk_size = chunk_size or current_app.config['OAREPO_REFERENCES_CHUNK_SIZE']
+        query = db.session.query(RecordReference.id,
+                                 RecordReference.reference,
+                                 RecordReference.reference_uuid,
+                                 RecordReference.content_digest,
+                                 RecordReference.json_paths,
+                                 ReferencingRecord.class_id,
+                                 ReferencingRecord.record_uuid) \
+            .join(ReferencingRecord, RecordReference.record_id == ReferencingRecord.id) \
+            .filter(or_(*conditions))
+        if inline is not None:
+            query = query.filter(RecordReference.inline.is_(inline))
+        query = query.order_by(RecordReference.id)
+
+        last_id = None
+        while True:
+            chunk_query = query
+            if last_id is not None:
+                chunk_query = chunk_query.filter(RecordReference.id > last_id)
+            chunk = chunk_query.limit(chunk_size).all()
+            if not chunk:
+                return
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+            last_id = chunk[-1].id
+
+    @classmethod
+    def get_referrers(cls, references=(), inline=None, reference_uuids=()):
+        """Retrieve records referencing any of the given references.
+
+        All the rows are loaded at once, see :meth:`iter_referrers`
+        for iterating them chunk by chunk.
+
+        :param references: An iterable of reference URIs
+        :param inline: if set, return only records (not) inlining the references
+        :param reference_uuids: An iterable of UUIDs of referenced records
+        :returns: A list of rows as yielded by :meth:`iter_referrers`
+        """
+        return [row for chunk in cls.iter_referrers(references, inline, reference_uuids)
+                for row in chunk]
+
+    @classmethod
+    def lock_referrers(cls, referrers):
+        """Lock and load reference enabled referencing records.
+
+        Records are locked and loaded class by class in chunked
+        ``SELECT ... FOR UPDATE`` queries, so every record is loaded
+        exactly once, after its lock has been taken.
+
+        :param referrers: A dict mapping ClassName ids to lists of record UUIDs,
+                          as returned by :meth:`get_referrer_ids_by_class`
+        :returns: A generator of locked Record instances
+        """
+        return cls.load_referrers(referrers, lock=True)
+
+    @classmethod
+    def load_referrers(cls, referrers, lock=False):
+        """Load reference enabled referencing records class by class, in chunks.
+
+        Records that have been deleted are skipped.
+
+        :param referrers: A dict mapping ClassName ids to lists of record UUIDs,
+                          as returned by :meth:`get_referrer_ids_by_class`
+        :param lock: lock the records by ``SELECT ... FOR UPDATE`` queries
+        :returns: A generator of Record instances
+        """
+        chunk_size = current_app.config['OAREPO_REFERENCES_LOCK_CHUNK_SIZE']
+        for class_id, record_uuids in referrers.items():
+            rec_cls = obj_or_import_string(ClassName.get_name(class_id), Record)
+            if not issubclass(rec_cls, ReferenceEnabledRecordMixin):
+                continue
+
+            model_cls = rec_cls.model_cls
+            record_uuids = sorted(record_uuids)
+            for i in range(0, len(record_uuids), chunk_size):
+                query = model_cls.query \
+                    .filter(model_cls.id.in_(record_uuids[i:i + chunk_size])) \
+                    .filter(model_cls.json.isnot(None)) \
+                    .order_by(model_cls.id)
+                if lock:
+                    query = query.with_for_update().populate_existing()
+                for model in query.all():
+                    yield rec_cls(model.json, model=model)
+
     @classmethod
     def delete_references_record(cls, record):
         """Delete all reference records of a certain Record from a database.
@@ -112,23 +488,266 @@ class RecordReferenceAPI(object):
         ReferencingRecord.query.filter_by(record_uuid=record.model.id).delete()
 
     @classmethod
-    def reindex_referencing_records(cls, ref, ref_obj=None):
+    def delete_orphaned_references(cls):
+        """Delete reference records of records that no longer exist or have been deleted.
+
+        Referencing records are checked against the table of their record class.
+
+        :return: number of removed referencing records
+        """
+        chunk_size = current_app.config['OAREPO_REFERENCES_CHUNK_SIZE']
+        removed = 0
+        class_ids = [v for v, in db.session.query(ReferencingRecord.class_id).distinct()]
+        for class_id in class_ids:
+            rec_cls = Record
+            if class_id is not None:
+                rec_cls = obj_or_import_string(ClassName.get_name(class_id), Record)
+            model_cls = getattr(rec_cls, 'model_cls', None) or RecordMetadata
+            live_record = exists().where(and_(
+                model_cls.id == ReferencingRecord.record_uuid,
+                model_cls.json.isnot(None)
+            ))
+            after = None
+            while True:
+                query = db.session.query(ReferencingRecord.id) \
+                    .filter(ReferencingRecord.class_id == class_id) \
+                    .filter(~live_record) \
+                    .order_by(ReferencingRecord.id)
+                if after is not None:
+                    query = query.filter(ReferencingRecord.id > after)
+                chunk = [v for v, in query.limit(chunk_size)]
+                if not chunk:
+                    break
+                # bulk deletes do not cascade in the session, remove references explicitly
+                RecordReference.query.filter(RecordReference.record_id.in_(chunk)) \
+                    .delete(synchronize_session=False)
+                ReferencingRecord.query.filter(ReferencingRecord.id.in_(chunk)) \
+                    .delete(synchronize_session=False)
+                removed += len(chunk)
+                after = chunk[-1]
+        return removed
+
+    @classmethod
+    def update_references_from_record(cls, record):
+        """Recompute references of a record from its metadata and store them.
+
+        :param record: Record with marshmallow validation of its metadata
+        :return: True if references were updated, False if the record does not support it
+        """
+        if not cls.collect_references_from_record(record):
+            return False
+        RecordReference.update_references(record, record.oarepo_references)
+        return True
+
+    @classmethod
+    def collect_references_from_record(cls, record):
+        """Recompute references of a record from its metadata, without storing them.
+
+        :param record: Record with marshmallow validation of its metadata
+        :return: True if references were collected into ``record.oarepo_references``,
+                 False if the record does not support it
+        """
+        if not hasattr(record, 'validate_marshmallow'):
+            return False
+        # marshmallow validation collects references into record.oarepo_references
+        record.validate_marshmallow()
+        return True
+
+    @classmethod
+    def update_references_from_records(cls, record_uuids):
+        """Recompute and store references of multiple records.
+
+        References of all the records are stored by a single batch of bulk statements.
+        A record that fails to validate is skipped and does not abort the others.
+
+        :param record_uuids: UUIDs of records to be processed
+        :return: dict with counts of 'updated' and 'skipped' records
+        """
+        classes = cls.get_record_classes(record_uuids)
+        by_class = defaultdict(list)
+        stats = {'updated': 0, 'skipped': 0}
+        for record_uuid in record_uuids:
+            rec_cls = classes.get(record_uuid)
+            if rec_cls:
+                by_class[rec_cls].append(record_uuid)
+            else:
+                stats['skipped'] += 1
+
+        items = []
+        for rec_cls, ids in by_class.items():
+            for record in rec_cls.get_records(ids):
+                try:
+                    collected = cls.collect_references_from_record(record)
+                except Exception:
+                    log.exception('Failed to update references of record %s', record.id)
+                    collected = False
+                if collected:
+                    items.append((record, record.oarepo_references))
+                stats['updated' if collected else 'skipped'] += 1
+
+        RecordReference.update_references_many(items)
+        return stats
+
+    @classmethod
+    def get_record_classes(cls, record_uuids):
+        """Resolve record classes of records.
+
+        A class stored with the references of a record takes precedence, otherwise
+        the class is taken from a REST endpoint of the record's persistent identifier.
+
+        :param record_uuids: UUIDs of records
+        :return: dict of record UUID -> record class
+        """
+        record_classes = {}
+        classes = {}
+        pids = db.session.query(PersistentIdentifier.object_uuid, PersistentIdentifier.pid_type) \
+            .filter(PersistentIdentifier.object_type == 'rec',
+                    PersistentIdentifier.object_uuid.in_(record_uuids),
+                    PersistentIdentifier.status == PIDStatus.REGISTERED)
+        for record_uuid, pid_type in pids:
+            if pid_type not in record_classes:
+                record_classes[pid_type] = next(
+                    (current_references.endpoint_prop(endpoint_name, endpoint, 'record_class')
+                     for endpoint_name, endpoint in current_references.endpoints.get(pid_type, ())
+                     if endpoint.get('record_class')), None)
+            if record_classes[pid_type] is not None:
+                classes[record_uuid] = record_classes[pid_type]
+
+        stored = db.session.query(ReferencingRecord.record_uuid, ReferencingRecord.class_id) \
+            .filter(ReferencingRecord.record_uuid.in_(record_uuids))
+        for record_uuid, class_id in stored:
+            classes[record_uuid] = obj_or_import_string(ClassName.get_name(class_id))
+        return classes
+
+    @classmethod
+    def iter_referrer_ids(cls, reference, chunk_size=None):
+        """Iterate UUIDs of existing records referencing a reference, chunk by chunk.
+
+        :param reference: Reference URI
+        :param chunk_size: number of reference records in a chunk,
+                           defaults to ``OAREPO_REFERENCES_CHUNK_SIZE``
+        :returns: A generator of lists of referencing record UUIDs
+        """
+        for refs in cls.iter_records(reference, chunk_size=chunk_size):
+            # only ids are needed, but referrers that have been deleted must be skipped
+            recids = [v for v, in db.session.query(RecordMetadata.id).filter(
+                RecordMetadata.id.in_([r.record.record_uuid for r in refs]),
+                RecordMetadata.json.isnot(None)
+            )]
+            if recids:
+                yield recids
+
+    @classmethod
+    def reindex_referencing_records(cls, ref, ref_obj=None, after_commit=None):
         """
         Reindex all records that reference given object or string reference.
 
+        Referencing records are processed chunk by chunk, the ``after_reference_update``
+        signal is sent for every chunk and chunks not handled by a signal receiver
+        are streamed to :meth:`bulk_reindex`.
+
         :param ref:         string reference to be checked
         :param ref_obj:     an object (record etc.) of the reference
+        :param after_commit: defer reindexing until the current transaction commits,
+                            defaults to ``OAREPO_REFERENCES_REINDEX_AFTER_COMMIT``
         """
-        refs = cls.get_records(ref)
-        records = Record.get_records([r.record.record_uuid for r in refs])
-        recids = [r.id for r in records]
         sender = ref_obj if ref_obj else ref
-        indexed = after_reference_update.send(sender, references=recids, ref_obj=ref_obj)
-        if not any([res[1] for res in indexed]):
-            RecordIndexer().bulk_index(recids)
-            RecordIndexer(version_type=cls.indexer_version_type).process_bulk_queue(
-                es_bulk_kwargs={'raise_on_error': True})
-            current_search_client.indices.flush()
+        if after_commit is None:
+            after_commit = current_app.config['OAREPO_REFERENCES_REINDEX_AFTER_COMMIT']
+        if after_commit:
+            for recids in cls.iter_referrer_ids(ref):
+                defer_reindex(sender, recids, ref_obj=ref_obj)
+            return
+
+        def _unhandled_referrer_ids():
+            for recids in cls.iter_referrer_ids(ref):
+                indexed = after_reference_update.send(sender, references=recids, ref_obj=ref_obj)
+                if not any([res[1] for res in indexed]):
+                    yield from recids
+
+        cls.bulk_reindex(_unhandled_referrer_ids())
+
+    @classmethod
+    def bulk_reindex(cls, record_uuids, indexer=None, record_class=None):
+        """
+        Reindex records by chunked bulk requests and refresh indices they are stored in.
+
+        Bulk requests are sent by a bounded number of threads, while the following chunks
+        of records are being loaded.
+
+        :param record_uuids: an iterable of UUIDs of records to be reindexed,
+                             consumed chunk by chunk
+        :param indexer: indexer of the records, defaults to a ``RecordIndexer``
+        :param record_class: record class to load all the records by, otherwise
+                             the class of each record is resolved by ``get_record_classes``
+        """
+        if indexer is None:
+            indexer = RecordIndexer(version_type=cls.indexer_version_type)
+        client = indexer.client
+        if isinstance(client, LocalProxy):
+            # the proxy can not be resolved in threads outside of the app context
+            client = client._get_current_object()
+        chunk_size = current_app.config['OAREPO_REFERENCES_REINDEX_CHUNK_SIZE']
+        concurrency = current_app.config['OAREPO_REFERENCES_REINDEX_CONCURRENCY']
+        record_uuids = iter(record_uuids)
+        indices = set()
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                chunk = list(islice(record_uuids, chunk_size))
+                if not chunk:
+                    break
+                if record_class is not None:
+                    records = record_class.get_records(chunk)
+                else:
+                    records = cls._get_records_of_classes(chunk, indexer.record_cls)
+                actions = [cls._index_action(indexer, record) for record in records]
+                indices.update(action['_index'] for action in actions)
+                pending.append(executor.submit(bulk, client, actions,
+                                               stats_only=True, raise_on_error=True))
+                if len(pending) >= concurrency:
+                    pending.popleft().result()
+            while pending:
+                pending.popleft().result()
+        if indices:
+            client.indices.refresh(index=','.join(sorted(indices)))
+
+    @classmethod
+    def _get_records_of_classes(cls, record_uuids, default_cls):
+        """Load records through their own record classes, class by class.
+
+        :param record_uuids: UUIDs of records
+        :param default_cls: record class of records whose class is not known
+        :returns: A list of Record instances, records that do not exist are skipped
+        """
+        classes = cls.get_record_classes(record_uuids)
+        by_class = defaultdict(list)
+        for record_uuid in record_uuids:
+            by_class[classes.get(record_uuid, default_cls)].append(record_uuid)
+        return [record for rec_cls, uuids in by_class.items()
+                for record in rec_cls.get_records(uuids)]
+
+    @classmethod
+    def _index_action(cls, indexer, record):
+        """Return a bulk action indexing a loaded record as the indexer would.
+
+        The same as ``RecordIndexer._index_action``, except that the record
+        is not loaded again by the base record class of the indexer.
+        """
+        index, doc_type = indexer.record_to_index(record)
+        arguments = {}
+        body = indexer._prepare_record(record, index, doc_type, arguments)
+        index, doc_type = indexer._prepare_index(index, doc_type)
+        action = {
+            '_op_type': 'index',
+            '_index': index,
+            '_id': str(record.id),
+            '_version': record.revision_id,
+            '_version_type': indexer._version_type,
+            '_source': body
+        }
+        action.update(arguments)
+        return action
 
 
 __all__ = (
@@ -7,34 +7,310 @@
 
 """OArepo module for tracking and updating references in Invenio records."""
 
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
 import click
+from flask import current_app
 from flask.cli import with_appcontext
 from invenio_db import db
-from invenio_records import Record
 from invenio_records.models import RecordMetadata
 
 from oarepo_references.models import RecordReference
 from oarepo_references.proxies import current_references
 
+_worker_app = None
+"""Flask application used by synchronize worker processes."""
+
+_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
 
 @click.group()
 def references():
     """References support for OArepo."""
 
 
+def _records_query(after=None, since=None):
+    """Return a query of (id, updated) of all (not deleted) records, ordered by id.
+
+    Records are paged by their primary key, the time of their last update,
+    which is not indexed, is only filtered on.
+
+    :param after: (id, updated) of the last record of a previous chunk
+    :param since: process only records updated at this time or later
+    """
+    query = db.session.query(RecordMetadata.id, RecordMetadata.updated) \
+        .filter(RecordMetadata.json.isnot(None))
+    if since is not None:
+        query = query.filter(RecordMetadata.updated >= since)
+    if after is not None:
+        query = query.filter(RecordMetadata.id > after[0])
+    return query.order_by(RecordMetadata.id)
+
+
+def _iter_record_chunks(chunk_size, after=None, since=None):
+    """Yield chunks of (id, updated) of all (not deleted) records, see :func:`_records_query`.
+
+    :param after: (id, updated) of the last record of a previous chunk
+    :param since: process only records updated at this time or later
+    """
+    while True:
+        chunk = _records_query(after, since).limit(chunk_size).all()
+        db.session.commit()
+        if not chunk:
+            return
+        yield chunk
+        after = chunk[-1]
+
+
+def _dump_position(row):
+    """Serialize (id, updated) of a record into a checkpoint."""
+    return {'id': str(row[0]), 'updated': row[1].strftime(_TIMESTAMP_FORMAT)}
+
+
+def _load_position(position):
+    """Deserialize (id, updated) of a record from a checkpoint."""
+    if not position:
+        return None
+    return position['id'], _load_timestamp(position['updated'])
+
+
+def _load_timestamp(timestamp):
+    """Deserialize a time of a record update from a checkpoint."""
+    return datetime.strptime(timestamp, _TIMESTAMP_FORMAT) if timestamp else None
+
+
+def _init_worker():
+    """Initialize a synchronize worker process with its own app context and DB session."""
+    _worker_app.app_context().push()
+
+
+def _synchronize_chunk(record_uuids):
+    """Recompute references of a chunk of records and commit them."""
+    try:
+        stats = current_references.update_references_from_records(record_uuids)
+        db.session.commit()
+        return stats
+    except Exception as e:
+        db.session.rollback()
+        # errors are sent from worker processes pickled, database errors might not be picklable
+        raise click.ClickException('Synchronizing records {} to {} failed: {}'.format(
+            record_uuids[0], record_uuids[-1], e)) from e
+
+
+def _read_checkpoint(path):
+    """Return the content of a checkpoint or watermark file, or None if there is none."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_checkpoint(path, checkpoint):
+    """Atomically store a synchronize checkpoint or watermark file."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+class _Progress(object):
+    """Progress and checkpoint of a synchronize run."""
+
+    def __init__(self, checkpoint_path, state, total):
+        """Initialize progress of a run."""
+        self.checkpoint_path = checkpoint_path
+        self.state = state
+        self.total = total
+        self.updated = 0
+        self.skipped = 0
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self):
+        """Seconds since the start of the run."""
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        """Records processed per second."""
+        elapsed = self.elapsed
+        return (self.updated + self.skipped) / elapsed if elapsed else 0
+
+    def chunk_done(self, last, stats):
+        """Account a processed chunk, store the checkpoint and report the progress."""
+        self.updated += stats['updated']
+        self.skipped += stats['skipped']
+        self.state['last'] = _dump_position(last)
+        self.state['processed'] += stats['updated'] + stats['skipped']
+        _write_checkpoint(self.checkpoint_path, self.state)
+        click.echo('Synchronized {}/{} records, {} skipped ({:.1f} records/s)'.format(
+            self.updated + self.skipped, self.total, self.skipped, self.rate))
+
+
 #
 # References subcommands
 #
 @references.command('synchronize')
-@click.option('--clear/--no-clear', default=False)
+@click.option('--clear/--no-clear', default=False,
+              help='Remove all references before a new (not resumed) run.')
+@click.option('--workers', default=1, show_default=True,
+              help='Number of worker processes.')
+@click.option('--chunk-size', default=500, show_default=True,
+              help='Number of records processed by a worker at once.')
+@click.option('--checkpoint', type=click.Path(dir_okay=False), default=None,
+              help='Checkpoint file, defaults to a file in the instance folder.')
+@click.option('--restart', is_flag=True, default=False,
+              help='Ignore a checkpoint left by an interrupted run.')
+@click.option('--incremental', is_flag=True, default=False,
+              help='Process only records updated since the last finished run.')
+@click.option('--watermark', type=click.Path(dir_okay=False), default=None,
+              help='Watermark file of the last finished run, '
+                   'defaults to a file in the instance folder.')
 @with_appcontext
-def synchronize(clear):
+def synchronize(clear, workers, chunk_size, checkpoint, restart, incremental, watermark):
     """Scan all records and update references table."""
-    rms = [v for v, in db.session.query(RecordMetadata.id).all()]
-    records = Record.get_records(rms)
-    if clear:
-        RecordReference.query.delete()
-
-    for rec in records:
-        click.echo('Updating reference records for record: {}'.format(rec.id))
-        current_references.update_references_from_record(rec)
+    global _worker_app
+
+    if clear and incremental:
+        raise click.UsageError('--clear cannot be used with --incremental')
+
+    checkpoint_path = checkpoint or os.path.join(
+        current_app.instance_path, 'oarepo-references-synchronize.json')
+    watermark_path = watermark or os.path.join(
+        current_app.instance_path, 'oarepo-references-watermark.json')
+
+    state = None if restart else _read_checkpoint(checkpoint_path)
+    if state and state.get('incremental') != incremental:
+        click.echo('Ignoring checkpoint of a run in a different mode')
+        state = None
+    if state:
+        click.echo('Resuming after record {}, {} records already processed'.format(
+            state['last'] and state['last']['id'], state['processed']))
+    else:
+        # records updated after the start of this run are left to the next incremental run
+        head = db.session.query(RecordMetadata.id, RecordMetadata.updated) \
+            .order_by(RecordMetadata.updated.desc(), RecordMetadata.id.desc()) \
+            .first()
+        since = None
+        if incremental:
+            watermark_last = _load_position((_read_checkpoint(watermark_path) or {}).get('last'))
+            if watermark_last is None:
+                click.echo('No watermark found, processing all records')
+            else:
+                # transactions running at the start of the last run might have committed
+                # records updated before its watermark, process them again
+                lag = timedelta(seconds=current_app.config['OAREPO_REFERENCES_SYNCHRONIZE_LAG'])
+                since = (watermark_last[1] - lag).strftime(_TIMESTAMP_FORMAT)
+        state = {
+            'incremental': incremental,
+            'head': head and _dump_position(head),
+            'since': since,
+            'last': None,
+            'processed': 0
+        }
+        if clear:
+            RecordReference.query.delete()
+        db.session.commit()
+
+    last = _load_position(state['last'])
+    since = _load_timestamp(state.get('since'))
+    total = _records_query(last, since).order_by(None).count()
+    db.session.commit()
+
+    chunks = _iter_record_chunks(chunk_size, after=last, since=since)
+    pool = None
+    if workers > 1:
+        _worker_app = current_app._get_current_object()
+        # forked workers must not share connections of this process
+        db.session.remove()
+        db.engine.dispose()
+        pool = multiprocessing.get_context('fork').Pool(workers, initializer=_init_worker)
+
+    progress = _Progress(checkpoint_path, state, total)
+    pending = deque()
+    try:
+        for chunk in chunks:
+            record_uuids = [row[0] for row in chunk]
+            if not pool:
+                progress.chunk_done(chunk[-1], _synchronize_chunk(record_uuids))
+                continue
+            pending.append((chunk[-1], pool.apply_async(_synchronize_chunk, (record_uuids,))))
+            if len(pending) >= workers * 2:
+                # results are collected in order, so the checkpoint never skips a chunk
+                last, result = pending.popleft()
+                progress.chunk_done(last, result.get())
+        while pending:
+            last, result = pending.popleft()
+            progress.chunk_done(last, result.get())
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    removed = current_references.delete_orphaned_references()
+    db.session.commit()
+
+    if state['head']:
+        _write_checkpoint(watermark_path, {'last': state['head']})
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    click.echo('Synchronized references of {} records, {} skipped, in {:.1f}s ({:.1f} records/s)'
+               .format(progress.updated, progress.skipped, progress.elapsed, progress.rate))
+    click.echo('Removed references of {} deleted records'.format(removed))
+
+
+@references.command('rename')
+@click.argument('old')
+@click.argument('new')
+@click.option('--prefix', is_flag=True, default=False,
+              help='Rename all references starting with OLD.')
+@click.option('--chunk-size', default=500, show_default=True,
+              help='Number of referencing records rewritten and committed at once.')
+@click.option('--checkpoint', type=click.Path(dir_okay=False), default=None,
+              help='Checkpoint file, defaults to a file in the instance folder.')
+@click.option('--restart', is_flag=True, default=False,
+              help='Ignore a checkpoint left by an interrupted run.')
+@with_appcontext
+def rename(old, new, prefix, chunk_size, checkpoint, restart):
+    """Rename references OLD to NEW and rewrite referencing records."""
+    checkpoint_path = checkpoint or os.path.join(
+        current_app.instance_path, 'oarepo-references-rename.json')
+    params = {'old': old, 'new': new, 'prefix': prefix}
+
+    state = None if restart else _read_checkpoint(checkpoint_path)
+    if state and state['params'] != params:
+        raise click.UsageError('A checkpoint of a different rename exists, '
+                               'finish that rename or pass --restart')
+    if state:
+        click.echo('Resuming after referencing record {last}, {processed} records '
+                   'already rewritten'.format(**state))
+    else:
+        renamed = current_references.rename_references(old, new, prefix=prefix)
+        state = {'params': params, 'last': None, 'processed': 0}
+        _write_checkpoint(checkpoint_path, state)
+        db.session.commit()
+        click.echo('Renamed references of {} records'.format(renamed))
+
+    started = time.monotonic()
+    rewritten = 0
+    for last, records in current_references.rewrite_renamed_references(
+            old, new, prefix=prefix, after=state['last'],
+            chunk_size=chunk_size):
+        db.session.commit()
+        rewritten += len(records)
+        state['last'] = last
+        state['processed'] += len(records)
+        _write_checkpoint(checkpoint_path, state)
+        elapsed = time.monotonic() - started
+        click.echo('Rewritten {} referencing records ({:.1f} records/s)'.format(
+            state['processed'], rewritten / elapsed if elapsed else 0))
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    click.echo('Rewritten {} referencing records in {:.1f}s'.format(
+        state['processed'], time.monotonic() - started))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Miroslav Bauer, CESNET.
+#
+# oarepo-references is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License; see LICENSE file for more details.
+
+"""OArepo module for tracking and updating references in Invenio records."""
+
+OAREPO_REFERENCES_CHUNK_SIZE = 1000
+"""Number of reference records fetched at once when iterating referencing records."""
+
+OAREPO_REFERENCES_LOCK_CHUNK_SIZE = 500
+"""Number of referencing records locked and loaded by a single ``SELECT ... FOR UPDATE``."""
+
+OAREPO_REFERENCES_PROPAGATION_MAX_DEPTH = None
+"""Maximal number of reference levels a changed inlined content is propagated through.
+
+Set to None to propagate through all levels, reference cycles are never followed.
+"""
+
+OAREPO_REFERENCES_PROPAGATION_ASYNC = False
+"""Propagate changed inlined content by a Celery task instead of inside the saving request."""
+
+OAREPO_REFERENCES_PROPAGATION_COUNTDOWN = 5
+"""Seconds a deferred propagation waits for further changes of the same record.
+
+Repeated changes within this window are propagated once, with the latest content.
+"""
+
+OAREPO_REFERENCES_PATCH_INLINED = False
+"""Replace changed inlined contents at their stored JSON paths.
+
+Referencing records are not revalidated as a whole, only the replaced contents are processed.
+
+See :meth:`oarepo_references.mixins.ReferenceEnabledRecordMixin.patch_inlined_refs`.
+"""
+
+OAREPO_REFERENCES_REINDEX_CHUNK_SIZE = 500
+"""Number of referencing records sent to the search engine in a single bulk request."""
+
+OAREPO_REFERENCES_REINDEX_CONCURRENCY = 4
+"""Maximal number of bulk requests reindexing referencing records sent at the same time."""
+
+OAREPO_REFERENCES_REINDEX_AFTER_COMMIT = False
+"""Reindex referencing records once after the transaction commits instead of on every change.
+
+Referencing records collected from all changes within a transaction are deduplicated,
+nothing is reindexed when the transaction is rolled back.
+"""
+
+OAREPO_REFERENCES_SYNCHRONIZE_LAG = 60
+"""Seconds before the watermark of the last run processed again by an incremental synchronize.
+
+Records saved by transactions still running when a run started might be committed
+with an update time older than its watermark.
+"""
+
+OAREPO_REFERENCES_TASK_CHUNK_SIZE = 100
+"""Number of tasks run in parallel by ``run_task_on_referrers`` with ``ids_only``."""
+
+OAREPO_REFERENCES_UUID_CACHE_SIZE = 10000
+"""Maximal number of reference URLs with their resolved record UUIDs kept in memory.
+
+Set to 0 to disable the cache.
+"""
+
+OAREPO_REFERENCES_UUID_CACHE_TTL = 300
+"""Seconds a resolved record UUID is kept in memory.
+
+Persistent identifiers changed by other processes are seen once their entries expire.
+Set to None to keep entries until they are evicted or their persistent identifier changes.
+"""
@@ -9,7 +9,15 @@
 
 from __future__ import absolute_import, print_function
 
+from invenio_db import db
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.utils import cached_property
+
+from oarepo_references import config
 from oarepo_references.api import RecordReferenceAPI
+from oarepo_references.models import ClassName
+from oarepo_references.utils import build_endpoint_index, \
+    reference_uuid_cache, resolve_endpoint_prop
 
 
 class _RecordReferencesState(RecordReferenceAPI):
@@ -18,8 +26,27 @@ class _RecordReferencesState(RecordReferenceAPI):
     def __init__(self, app):
         """Initialize state."""
         self.app = app
+        self._endpoint_props = {}
         super(_RecordReferencesState, self).__init__()
 
+    @cached_property
+    def endpoints(self):
+        """REST endpoints indexed by their PID type.
+
+        Built on the first use, once all extensions have registered their endpoints.
+        """
+        return build_endpoint_index(self.app.config.get('RECORDS_REST_ENDPOINTS', {}))
+
+    def endpoint_prop(self, endpoint_name, endpoint, prop):
+        """Property of a REST endpoint with its minter or class resolved.
+
+        Resolved on the first use and cached per endpoint.
+        """
+        key = (endpoint_name, prop)
+        if key not in self._endpoint_props:
+            self._endpoint_props[key] = resolve_endpoint_prop(prop, endpoint[prop])
+        return self._endpoint_props[key]
+
 
 class OARepoReferences(object):
     """oarepo-references extension."""
@@ -31,6 +58,28 @@ class OARepoReferences(object):
 
     def init_app(self, app):
         """Flask application initialization."""
+        self.init_config(app)
         state = _RecordReferencesState(app)
         app.extensions['oarepo-references'] = state
+        reference_uuid_cache.maxsize = app.config['OAREPO_REFERENCES_UUID_CACHE_SIZE']
+        reference_uuid_cache.ttl = app.config['OAREPO_REFERENCES_UUID_CACHE_TTL']
+        self.warm_class_name_cache(app)
         return state
+
+    def init_config(self, app):
+        """Initialize configuration."""
+        for k in dir(config):
+            if k.startswith('OAREPO_REFERENCES_'):
+                app.config.setdefault(k, getattr(config, k))
+
+    def warm_class_name_cache(self, app):
+        """Preload ClassName ids of referencing record classes."""
+        if 'sqlalchemy' not in app.extensions:
+            # the cache gets filled on demand
+            return
+        with app.app_context():
+            try:
+                ClassName.warm_cache()
+            except SQLAlchemyError:
+                # the tables might not have been created yet
+                db.session.rollback()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Miroslav Bauer, CESNET.
+#
+# oarepo-references is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License; see LICENSE file for more details.
+
+"""Indexing of records deferred until a transaction commits."""
+
+from __future__ import absolute_import, print_function
+
+import itertools
+import logging
+from collections import OrderedDict
+
+from invenio_indexer.api import RecordIndexer
+from invenio_records.models import RecordMetadata
+
+from oarepo_references.proxies import current_references
+from oarepo_references.signals import after_reference_update
+from oarepo_references.utils import TransactionState
+
+log = logging.getLogger(__name__)
+
+_senders = itertools.count()
+"""Sequence keeping senders of deferred reindexing apart."""
+
+
+def defer_reindex(sender, record_uuids, ref_obj=None):
+    """Collect referencing records to be reindexed once the current transaction commits.
+
+    Records collected by all calls within a transaction are reindexed once,
+    no matter how many references they have changed.
+
+    :param sender: changed reference or referenced object
+    :param record_uuids: UUIDs of referencing records
+    :param ref_obj: referenced object
+    """
+    _deferred_reindex[('sender', next(_senders))] = (sender, ref_obj)
+    for record_uuid in record_uuids:
+        _deferred_reindex[('record', record_uuid)] = None
+
+
+def defer_index(indexer_class, record_uuids, record_class=None):
+    """Collect records to be indexed by a bulk request once the current transaction commits.
+
+    :param indexer_class: indexer class of the records
+    :param record_uuids: UUIDs of records
+    :param record_class: record class the records are loaded and dumped by,
+                         resolved from their references or PIDs if not given
+    """
+    for record_uuid in record_uuids:
+        _deferred_index[(indexer_class, record_class, record_uuid)] = None
+
+
+def _bulk_reindex(record_uuids, indexer_class=None, record_class=None):
+    """Reindex records of a committed transaction, queueing them for indexing on failure.
+
+    Errors are logged, not raised, the transaction has already been committed.
+    """
+    try:
+        current_references.bulk_reindex(
+            record_uuids, indexer=indexer_class() if indexer_class else None,
+            record_class=record_class)
+    except Exception:
+        log.exception('References: reindexing of %d records failed, queueing them for indexing',
+                      len(record_uuids))
+        try:
+            (indexer_class or RecordIndexer)().bulk_index(record_uuids)
+        except Exception:
+            log.exception('References: queueing of %d records for indexing failed',
+                          len(record_uuids))
+
+
+def _run_deferred_reindex(session, entries):
+    """Reindex referencing records collected by a committed transaction."""
+    senders, ref_objs, record_uuids = [], [], []
+    for (kind, key), value in entries.items():
+        if kind == 'record':
+            record_uuids.append(key)
+            continue
+        sender, ref_obj = value
+        senders.append(sender)
+        if ref_obj is not None:
+            ref_objs.append(ref_obj)
+    try:
+        indexed = after_reference_update.send(senders, references=record_uuids,
+                                              ref_obj=ref_objs)
+    except Exception:
+        log.exception('References: a handler of the reference update signal failed')
+        indexed = []
+    if record_uuids and not any([res[1] for res in indexed]):
+        _bulk_reindex(record_uuids)
+
+
+def _run_deferred_index(session, entries):
+    """Index records collected by a committed transaction."""
+    pending = OrderedDict()
+    for indexer_class, record_class, record_uuid in entries:
+        pending.setdefault((indexer_class, record_class), []).append(record_uuid)
+    for (indexer_class, record_class), record_uuids in pending.items():
+        # records deleted later in the transaction do not exist
+        existing = [v for v, in session.query(RecordMetadata.id).filter(
+            RecordMetadata.id.in_(record_uuids),
+            RecordMetadata.json.isnot(None)
+        )]
+        if existing:
+            _bulk_reindex(existing, indexer_class, record_class)
+
+
+_deferred_reindex = TransactionState('oarepo_references_reindex', _run_deferred_reindex)
+"""Referencing records to be reindexed and the senders of their changes."""
+
+_deferred_index = TransactionState('oarepo_references_index', _run_deferred_index)
+"""Records to be indexed, keyed by their indexer class, record class and UUID."""
+
+
+__all__ = (
+    'defer_index',
+    'defer_reindex',
+)
@@ -7,15 +7,36 @@
 
 """OArepo module for tracking and updating references in Invenio records."""
 import abc
+import copy
 import typing
 import uuid
+from collections import OrderedDict
 
 from flask import current_app
 from flask_principal import Permission
 from invenio_base.utils import obj_or_import_string
+from invenio_db import db
 from invenio_indexer.api import RecordIndexer
 from invenio_pidstore import current_pidstore
-from marshmallow import missing, post_load, pre_load, validates_schema
+from invenio_records import Record
+from invenio_records.signals import after_record_insert, before_record_insert
+from jsonpatch import apply_patch
+from marshmallow import Schema, ValidationError, missing, post_load, pre_load, \
+    validates_schema
+from marshmallow.fields import List, Nested
+
+from oarepo_references.indexing import defer_index
+from oarepo_references.models import RecordReference
+from oarepo_references.proxies import current_references
+from oarepo_references.utils import LinkValue, TransactionState, \
+    class_import_string, content_digest
+
+_created_objects = TransactionState('oarepo_references_created_objects')
+"""Final representations of objects created in the current transaction."""
+
+
+class _CreatedObjectData(dict):
+    """Data of an object created by a batch, not to be created again by a per-item hook."""
 
 
 class ReferenceEnabledRecordMixin(object):
@@ -29,24 +50,136 @@ class ReferenceEnabledRecordMixin(object):
             'content': ref_obj
         })
 
-    def update_ref(self, old_url, new_url):
-        """Update reference URL to another object."""
+    def update_inlined_refs(self, changes):
+        """Update contents of several inlined references in a record by a single commit.
+
+        :param changes: a list of dicts with ``url``, ``uuid`` and ``content`` keys
+        """
+        self.commit(changed_references=changes)
+
+    def patch_inlined_refs(self, changes):
+        """Replace contents of inlined references at their JSON paths by a single commit.
+
+        Unlike :meth:`update_inlined_refs`, the record is not revalidated
+        by marshmallow as a whole, only :meth:`postprocess_patched_reference_data`
+        is called on every replaced subtree.
+
+        :param changes: a list of dicts with ``url``, ``uuid``, ``content``
+                        and ``paths`` (JSON pointers) keys
+        """
+        patch = []
+        digests = {}
+        for change in changes:
+            for path in change['paths']:
+                content = self.postprocess_patched_reference_data(path, change['content'])
+                # the digest the content would be stored with by a full revalidation
+                digests[change['url']] = self.inlined_content_digest(path, change['content']) \
+                    or content_digest(content)
+                patch.append({'op': 'replace', 'path': path, 'value': content})
+        apply_patch(self, patch, in_place=True)
+
+        # references stay the same, only digests of the inlined contents change
+        self.oarepo_references = [
+            dict(ref, content_digest=digests.get(ref['reference'], ref['content_digest']))
+            for ref in RecordReference.get_reference_specs(self.id)
+        ]
+        self.commit(validate_marshmallow=False)
+
+    @classmethod
+    def get_inline_reference_schema(cls, path):
+        """Return the inline reference schema of the data at a JSON path of the record.
+
+        The marshmallow schema of the record is walked along the path, following
+        nested schemas and list items.
+
+        :param path: JSON pointer into the record
+        :return: an instance of the :class:`InlineReferenceMixin` schema or None
+        """
+        schema_class = getattr(cls, 'MARSHMALLOW_SCHEMA', None)
+        if schema_class is None:
+            return None
+        node = obj_or_import_string(schema_class)()
+        for segment in path.split('/')[1:]:
+            segment = segment.replace('~1', '/').replace('~0', '~')
+            if isinstance(node, Schema) and not node.many:
+                node = next((field for name, field in node.fields.items()
+                             if (field.data_key or name) == segment), None)
+            elif segment.isdigit() and isinstance(node, List):
+                node = node.inner
+            elif segment.isdigit() and isinstance(node, Schema):
+                node = type(node)(context=node.context)
+            else:
+                return None
+            if isinstance(node, Nested):
+                node = node.schema
+        return node if isinstance(node, InlineReferenceMixin) and not node.many else None
+
+    @classmethod
+    def inlined_content_digest(cls, path, content):
+        """Return the digest of a reference content as stored when inlined at a JSON path.
+
+        The content is processed and validated by the inline reference schema at the path,
+        the same way as when the record is updated by :meth:`update_inlined_ref`.
+
+        :param path: JSON pointer of the inlined reference in the record
+        :param content: the reference content
+        :return: the content digest or None if it can not be computed
+        """
+        schema = cls.get_inline_reference_schema(path)
+        if schema is None:
+            return None
+        schema.context = {'references': []}
+        try:
+            schema.load(schema.postprocess_inline_reference_data(copy.deepcopy(dict(content))))
+        except ValidationError:
+            return None
+        references = schema.context['references']
+        return references[-1]['content_digest'] if references else None
+
+    def postprocess_patched_reference_data(self, path, data):
+        """
+        Process and optionally validate a content patched into the record at path.
+
+        The default implementation returns a copy of the data processed by
+        ``postprocess_inline_reference_data`` of the inline reference schema at the path,
+        if there is one. Override it to validate just the patched subtree.
+        """
+        data = copy.deepcopy(dict(data))
+        schema = self.get_inline_reference_schema(path)
+        if schema is None:
+            return data
+        return schema.postprocess_inline_reference_data(data)
+
+    def update_ref(self, old_url, new_url, prefix=False):
+        """Update reference URL to another object.
+
+        :param prefix: replace the prefix ``old_url`` of all reference URLs with ``new_url``
+        """
         self.commit(renamed_reference={
             'old_url': old_url,
-            'new_url': new_url
+            'new_url': new_url,
+            'prefix': prefix
         })
 
 
 class ReferenceFieldMixin(object):
     """Field Mixin representing a reference to another object."""
 
-    def register(self, reference, reference_uuid=None, inline=True):
-        """Registers a reference to the validation context."""
+    def register(self, reference, reference_uuid=None, inline=True, content_digest=None,
+                 data=None):
+        """Registers a reference to the validation context.
+
+        :param data: validated data of an inlined reference or the deserialized link,
+                     used to resolve its JSON path in the record after the validation
+        """
         refspec = dict(
             reference=reference,
             reference_uuid=reference_uuid,
-            inline=inline
+            inline=inline,
+            content_digest=content_digest
         )
+        if data is not None:
+            refspec['_data'] = data
         try:
             self.context['references'].append(refspec)
         except KeyError:
@@ -73,23 +206,62 @@ class ReferenceByLinkFieldMixin(ReferenceFieldMixin):
         changes = self.context.get('renamed_reference', None)
         if changes and value == changes['old_url']:
             value = changes['new_url']
+        elif changes and changes.get('prefix') and isinstance(value, str) \
+                and value.startswith(changes['old_url']) \
+                and not (changes['new_url'].startswith(changes['old_url'])
+                         and value.startswith(changes['new_url'])):
+            value = changes['new_url'] + value[len(changes['old_url']):]
 
         output = super(ReferenceByLinkFieldMixin, self).deserialize(value, attr, data, **kwargs)
         if output is missing:
             return output
-        self.register(output, inline=False)
+        if isinstance(output, str):
+            # a new object, so that its position is not confused with an equal string
+            output = LinkValue(output)
+            self.register(str(output), inline=False, data=output)
+        else:
+            self.register(output, inline=False)
         return output
 
 
 class InlineReferenceMixin(ReferenceFieldMixin):
     """Marshmallow mixin for inlined references."""
 
+    def changed_references_index(self):
+        """Return changes of the validated record indexed by reference URL and UUID.
+
+        The index is built once per validation and shared by all nested schemas,
+        so a record receiving many changes at once does not scan them for every inlined field.
+        """
+        index = self.context.get('changed_references_index', None)
+        if index is None:
+            changes = list(self.context.get('changed_references', None) or [])
+            if self.context.get('changed_reference', None):
+                changes.append(self.context['changed_reference'])
+            index = ({}, {})
+            # the first change of a reference wins, as when the changes were scanned in order
+            for change in reversed(changes):
+                index[0][change['url']] = change
+                if change.get('uuid') is not None:
+                    index[1][str(change['uuid'])] = change
+            self.context['changed_references_index'] = index
+        return index
+
     @pre_load
     def update_inline_changes(self, data, many, **kwargs):
         """Updates contents of the inlined reference."""
-        changes = self.context.get('changed_reference', None)
-        if changes and changes['url'] == self.ref_url(data):
-            data = self.postprocess_inline_reference_data(changes['content'])
+        if not self.context.get('changed_references', None) and \
+                not self.context.get('changed_reference', None):
+            return data
+
+        by_url, by_uuid = self.changed_references_index()
+        change = by_url.get(self.ref_url(data))
+        if change is None and by_uuid:
+            uuid = getattr(self, 'ref_uuid', None)
+            if uuid:
+                change = by_uuid.get(str(uuid(data)))
+        if change is not None:
+            return self.postprocess_inline_reference_data(change['content'])
 
         return data
 
@@ -103,7 +275,8 @@ class InlineReferenceMixin(ReferenceFieldMixin):
         if uuid:
             uuid = uuid(data)
         url = self.ref_url(data)
-        self.register(reference=url, reference_uuid=uuid)
+        self.register(reference=url, reference_uuid=uuid,
+                      content_digest=content_digest(data), data=data)
         return data
 
 
@@ -126,23 +299,115 @@ class CreateInlineReferenceMixin(InlineReferenceMixin):
     into a dictionary, omitting technical metadata (such as bucket id).
     """
 
+    create_in_batch = False
+    """
+    If set, referenced objects missing in data loaded with ``many=True`` are created together
+    by :meth:`create_referenced_objects` instead of one by one.
+    """
+
+    dedupe_created_objects = False
+    """
+    If set, identical data of objects to be created within a transaction create a single
+    object and all of its occurrences get the data of that object.
+    """
+
+    def is_referenced_object_created(self, data):
+        """
+        Return True if the data already reference an existing object.
+        """
+        try:
+            return self.ref_url(data) is not None
+        except KeyError:
+            return False
+
+    def created_object_key(self, data):
+        """
+        Return a key identifying data of an object to be created, or None if created objects
+        are not deduplicated.
+        """
+        if not self.dedupe_created_objects:
+            return None
+        return class_import_string(self), content_digest(data)
+
+    def get_created_object_data(self, key):
+        """
+        Return the final representation of an object created within the current transaction
+        from data with the given key, or None.
+        """
+        if key is None:
+            return None
+        object_data = _created_objects.get(key)
+        return copy.deepcopy(object_data) if object_data is not None else None
+
+    def remember_created_object_data(self, key, object_data):
+        """
+        Remember the final representation of an object created from data with the given key
+        until the end of the current transaction.
+        """
+        if key is not None:
+            _created_objects[key] = copy.deepcopy(object_data)
+
+    @pre_load(pass_many=True)
+    def create_records_in_batch_if_needed(self, data, many, **kwargs):
+        """
+        A pre-load hook called by marshmallow before the per-item hooks that creates
+        all the missing referenced records at once, if ``create_in_batch`` is set.
+        """
+        if not many or not self.create_in_batch or not isinstance(data, (list, tuple)):
+            return data
+
+        missing_indices = [idx for idx, item in enumerate(data)
+                           if not self.is_referenced_object_created(item)]
+        if not missing_indices:
+            return data
+
+        data = list(data)
+        # indices of items with identical data are created once, by the first of them
+        pending = OrderedDict()
+        for idx in missing_indices:
+            self.check_create_referenced_object_permissions(data[idx])
+            key = self.created_object_key(data[idx])
+            object_data = self.get_created_object_data(key)
+            if object_data is not None:
+                data[idx] = _CreatedObjectData(object_data)
+            else:
+                pending.setdefault(idx if key is None else key, []).append(idx)
+        if not pending:
+            return data
+
+        items = [data[indices[0]] for indices in pending.values()]
+        created_objects = self.create_referenced_objects(items)
+        for (key, indices), created_object in zip(pending.items(), created_objects):
+            object_data = self.serialize_created_object(created_object)
+            object_data = self.postprocess_created_object_data(object_data)
+            if not isinstance(key, int):
+                self.remember_created_object_data(key, object_data)
+            # the final representation might not reference the created object,
+            # mark it so that the per-item hook does not create it again
+            for idx in indices:
+                data[idx] = _CreatedObjectData(copy.deepcopy(object_data))
+        return data
+
     @pre_load
     def create_record_if_needed(self, data, many, **kwargs):
         """
         A pre-load hook called by marshmallow that checks if referenced record needs to be created
         and creates it if so.
         """
-        already_created = False
-        try:
-            already_created = self.ref_url(data) is not None
-        except KeyError:
-            pass
-        if already_created:
+        if isinstance(data, _CreatedObjectData):
+            return dict(data)
+        if self.is_referenced_object_created(data):
             return data
 
         # check if the caller can create the referenced record
         self.check_create_referenced_object_permissions(data)
 
+        # an object with identical data might have been created already
+        key = self.created_object_key(data)
+        object_data = self.get_created_object_data(key)
+        if object_data is not None:
+            return object_data
+
         # create the referenced record
         created_object = self.create_referenced_object(data)
 
@@ -153,6 +418,7 @@ class CreateInlineReferenceMixin(InlineReferenceMixin):
         object_data = self.postprocess_created_object_data(object_data)
 
         # and return the serialized data
+        self.remember_created_object_data(key, object_data)
         return object_data
 
     def check_create_referenced_object_permissions(self, data):
@@ -171,6 +437,12 @@ class CreateInlineReferenceMixin(InlineReferenceMixin):
         """
         raise RuntimeError('Implement "create_referenced_object" in your inline reference mixin')
 
+    def create_referenced_objects(self, items):
+        """
+        Create referenced objects from a list of data, in the order of the list.
+        """
+        return [self.create_referenced_object(data) for data in items]
+
     def serialize_created_object(self, created_object):
         """
         Serialize the created object into json-friendly representation. The default implementation
@@ -200,20 +472,21 @@ class CreateInlineRecordReferenceMixin(CreateInlineReferenceMixin):
     PID type of the referenced record.
     """
 
+    index_after_commit = False
+    """
+    If set, created records are indexed by a single bulk request after the enclosing
+    transaction commits (and not at all if it rolls back) instead of right away.
+    """
+
     def get_endpoint(self, test_func=lambda x: True):
         """
         Get endpoint configuration from the pid type.
         If test_func is set, filter the candidates by this test function.
         """
-        pid_type = self.pid_type
-        # at first take default prefixes and then the rest
-        for expected_default_endpoint_prefix in (True, False):
-            for endpoint_name, endpoint in current_app.config['RECORDS_REST_ENDPOINTS'].items():
-                endpoint_pid_type = endpoint.get('pid_type')
-                if expected_default_endpoint_prefix != endpoint.get('default_endpoint_prefix', False):
-                    continue
-                if endpoint_pid_type == pid_type and test_func(endpoint):
-                    return endpoint_name, endpoint
+        # endpoints with default prefixes come first
+        for endpoint_name, endpoint in current_references.endpoints.get(self.pid_type, ()):
+            if test_func(endpoint):
+                return endpoint_name, endpoint
         return None, None
 
     def get_endpoint_prop(self, prop, raise_exception=True):
@@ -228,7 +501,7 @@ class CreateInlineRecordReferenceMixin(CreateInlineReferenceMixin):
                 raise AttributeError(f'Could not get {prop} for pid type {self.pid_type}')
             else:
                 return None
-        return endpoint[prop]
+        return current_references.endpoint_prop(endpoint_name, endpoint, prop)
 
     @property
     def pid_minter(self):
@@ -278,10 +551,69 @@ class CreateInlineRecordReferenceMixin(CreateInlineReferenceMixin):
         self.index_record(created_record)
         return created_record
 
+    def create_referenced_objects(self, items):
+        """
+        Create referenced records within a single savepoint, mint their pids
+        and index them in elasticsearch by a single bulk operation if needed.
+        """
+        record_class = obj_or_import_string(self.record_class)
+        record_uuids = [uuid.uuid4() for _ in items]
+        with db.session.begin_nested():
+            self.mint_pids(record_uuids, items)
+            created_records = self.insert_records(record_class, record_uuids, items)
+        self.index_records(created_records)
+        return created_records
+
+    def mint_pids(self, record_uuids, items):
+        """
+        Mint pids of records to be created from a list of data. The default implementation
+        calls the minter for every record, override it if pids can be minted in bulk.
+        """
+        minter = self._resolve_minter(self.pid_minter)
+        for record_uuid, data in zip(record_uuids, items):
+            minter(record_uuid, data)
+
+    def insert_records(self, record_class, record_uuids, items):
+        """
+        Create records from a list of data and insert them by a single flush, sending
+        the same signals as ``Record.create``. Records of a class overriding ``create``
+        are created one by one by it.
+        """
+        if getattr(record_class.create, '__func__', None) is not Record.create.__func__:
+            return [record_class.create(data, id_=record_uuid)
+                    for record_uuid, data in zip(record_uuids, items)]
+
+        app = current_app._get_current_object()
+        created_records = []
+        for record_uuid, data in zip(record_uuids, items):
+            record = record_class(data)
+            before_record_insert.send(app, record=record)
+            record.validate()
+            record.model = record_class.model_cls(id=record_uuid, json=record)
+            created_records.append(record)
+        db.session.add_all([record.model for record in created_records])
+        db.session.flush()
+        for record in created_records:
+            after_record_insert.send(app, record=record)
+        return created_records
+
     def index_record(self, created_record):
         """
         Index created record in elasticsearch if needed.
         """
-        if self.index_name:
-            indexer = obj_or_import_string(self.record_indexer or RecordIndexer)
-            return indexer().index(created_record)
+        self.index_records([created_record])
+
+    def index_records(self, created_records):
+        """
+        Index created records in elasticsearch if needed.
+        """
+        if not self.index_name or not created_records:
+            return
+        indexer = obj_or_import_string(self.record_indexer or RecordIndexer)
+        if self.index_after_commit:
+            defer_index(indexer, [record.id for record in created_records],
+                        record_class=type(created_records[0]))
+        elif len(created_records) == 1:
+            indexer().index(created_records[0])
+        else:
+            indexer().bulk_index([record.id for record in created_records])
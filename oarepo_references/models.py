@@ -10,17 +10,126 @@
 from __future__ import absolute_import, print_function
 
 import uuid
+from collections import OrderedDict, defaultdict
 
 from invenio_db import db
 from invenio_records import Record
 from invenio_records.models import Timestamp
-from sqlalchemy import Boolean, Integer, String, UniqueConstraint
+from sqlalchemy import Boolean, Integer, String, UniqueConstraint, \
+    bindparam, event
+from sqlalchemy.dialects import mysql, postgresql
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import relationship
-from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy_utils.types import UUIDType
+from sqlalchemy.sql.expression import Insert
+from sqlalchemy_utils.types import JSONType, UUIDType
 
-from oarepo_references.utils import class_import_string, get_record_object
+from oarepo_references.utils import TransactionState, class_import_string, \
+    get_record_object
+
+
+_class_name_ids = {}
+"""Process-wide cache of ClassName ids keyed by a class import string."""
+
+_class_names = {}
+"""Process-wide cache of class import strings keyed by a ClassName id."""
+
+
+def _cache_class_name(class_id, name):
+    """Store a committed ClassName row in the process-wide cache."""
+    _class_name_ids[name] = class_id
+    _class_names[class_id] = name
+
+
+def _promote_session_class_names(session, session_names):
+    """Move ClassName ids created by a committed transaction to the process-wide cache."""
+    for name, class_id in session_names.items():
+        _cache_class_name(class_id, name)
+
+
+_session_class_names = TransactionState('oarepo_references_class_names',
+                                        _promote_session_class_names)
+"""ClassName ids created or seen uncommitted in the current transaction."""
+
+
+def clear_class_name_cache():
+    """Drop all entries of the process-wide ClassName cache."""
+    _class_name_ids.clear()
+    _class_names.clear()
+
+
+class _SQLiteInsertIgnoringConflicts(Insert):
+    """SQLite ``INSERT ... ON CONFLICT DO NOTHING``, not supported by SQLAlchemy itself."""
+
+    def __init__(self, table, index_elements):
+        """Initialize an insert into table skipping conflicts of index_elements."""
+        super(_SQLiteInsertIgnoringConflicts, self).__init__(table)
+        self.index_elements = index_elements
+
+
+@compiles(_SQLiteInsertIgnoringConflicts, 'sqlite')
+def _compile_sqlite_insert_ignoring_conflicts(insert, compiler, **kw):
+    """Append the ON CONFLICT clause to a compiled SQLite insert."""
+    return '{} ON CONFLICT ({}) DO NOTHING'.format(
+        compiler.visit_insert(insert, **kw),
+        ', '.join(compiler.preparer.quote(key) for key in insert.index_elements))
+
+
+def _insert_ignoring_conflicts(table, values, index_elements, returning=None):
+    """Insert rows into a table, skipping the rows that violate a unique constraint.
+
+    Concurrent writers of the same row do not fail, the row of the first one is kept.
+    PostgreSQL and SQLite use ``INSERT ... ON CONFLICT DO NOTHING``, MySQL
+    ``INSERT ... ON DUPLICATE KEY UPDATE`` of the primary key to itself, other databases
+    insert rows in savepoints. Violations of other constraints are raised.
+
+    :param table: table to insert into
+    :param values: dict of column values, or a list of them for a multi-row insert
+    :param index_elements: names of the columns of the unique constraint
+    :param returning: column reported for an inserted row (single row inserts only)
+    :return: list of ``returning`` values of the inserted row, or None if the database
+             does not report them
+    """
+    dialect = db.session.get_bind().dialect
+    if dialect.name == 'postgresql':
+        stmt = postgresql.insert(table).on_conflict_do_nothing(index_elements=index_elements)
+        if returning is not None and isinstance(values, dict):
+            return [row[0] for row in db.session.execute(stmt.returning(returning), values)]
+        db.session.execute(stmt, values)
+    elif dialect.name == 'mysql':
+        pk = table.primary_key.columns.values()[0]
+        stmt = mysql.insert(table).on_duplicate_key_update({pk.name: pk})
+        db.session.execute(stmt, values)
+    elif dialect.name == 'sqlite':
+        db.session.execute(_SQLiteInsertIgnoringConflicts(table, index_elements), values)
+    else:
+        for row in (values if isinstance(values, list) else [values]):
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(table.insert(), row)
+            except IntegrityError:
+                pass
+    return None
+
+
+def _get_or_insert_id(model, key, values):
+    """Return id of a row with the given unique key, inserting the row if it does not exist.
+
+    :param model: model of the table, with an ``id`` primary key
+    :param key: name of the unique column identifying the row
+    :param values: column values of the row to be inserted
+    :return: a tuple of the row id and True if the row has been inserted, False if it
+             already existed or None if it is not known
+    """
+    query = db.session.query(model.id).filter(getattr(model, key) == values[key])
+    row_id = query.scalar()
+    if row_id is not None:
+        return row_id, False
+    inserted = _insert_ignoring_conflicts(model.__table__, values, [key],
+                                          returning=model.__table__.c.id)
+    if inserted:
+        return inserted[0], True
+    return query.scalar(), None if inserted is None else False
 
 
 class ClassName(db.Model, Timestamp):
@@ -41,7 +150,69 @@ class ClassName(db.Model, Timestamp):
         with db.session.begin_nested():
             ret = cls(name=name)
             db.session.add(ret)
-            return ret
+        # not cached process-wide until the transaction commits
+        _session_class_names[name] = ret.id
+        return ret
+
+    @classmethod
+    def get_id(cls, name):
+        """
+        Return id of a ClassName, creating the ClassName if it does not exist yet.
+
+        The ids are cached process-wide, so that the database is queried
+        only on a cache miss.
+
+        :param name: import string of a record class
+        :return id of the ClassName
+        """
+        try:
+            return _class_name_ids[name]
+        except KeyError:
+            pass
+
+        class_id = _session_class_names.get(name)
+        if class_id is not None:
+            return class_id
+
+        # upserted, so that concurrent writers of a new name do not conflict
+        class_id, inserted = _get_or_insert_id(cls, 'name', dict(name=name))
+        if inserted is False:
+            _cache_class_name(class_id, name)
+        else:
+            # the row might still be uncommitted
+            _session_class_names[name] = class_id
+        return class_id
+
+    @classmethod
+    def get_name(cls, class_id):
+        """
+        Return a class import string of a ClassName.
+
+        :param class_id: id of the ClassName
+        :return class import string or None if the ClassName does not exist
+        """
+        try:
+            return _class_names[class_id]
+        except KeyError:
+            pass
+
+        name = db.session.query(cls.name).filter_by(id=class_id).scalar()
+        if name is not None and name not in _session_class_names:
+            _cache_class_name(class_id, name)
+        return name
+
+    @classmethod
+    def warm_cache(cls):
+        """Load all ClassName rows into the process-wide cache."""
+        for class_id, name in db.session.query(cls.id, cls.name):
+            _cache_class_name(class_id, name)
+
+
+@event.listens_for(ClassName.__table__, 'after_create')
+@event.listens_for(ClassName.__table__, 'after_drop')
+def _reset_class_name_cache(*args, **kwargs):
+    """Forget cached ids when the ClassName table is (re)created or dropped."""
+    clear_class_name_cache()
 
 
 class ReferencingRecord(db.Model, Timestamp):
@@ -51,25 +222,81 @@ class ReferencingRecord(db.Model, Timestamp):
 
     def __init__(self,
                  record_uuid: uuid.UUID,
-                 class_name: ClassName):
+                 class_name: ClassName = None,
+                 class_id: int = None):
         """Initialize record reference instance."""
         self.record_uuid = record_uuid
-        self.class_name = class_name
+        if class_name is not None:
+            self.class_name = class_name
+        else:
+            self.class_id = class_id
 
     @classmethod
-    def create(cls, record_uuid, class_name):
+    def create(cls, record_uuid, class_name=None, class_id=None):
         """
         Create a new ReferencingRecord.
 
         :param record_uuid: UUID of the referencing record
-        :param class_id: reference to a class of a referencing record
+        :param class_name: a class of a referencing record
+        :param class_id: id of a class of a referencing record, used if class_name is not given
         :return an instance of a created ReferencingRecord
         """
         with db.session.begin_nested():
-            ret = cls(record_uuid=record_uuid, class_name=class_name)
+            ret = cls(record_uuid=record_uuid, class_name=class_name, class_id=class_id)
             db.session.add(ret)
             return ret
 
+    @classmethod
+    def get_or_create(cls, record):
+        """
+        Return a ReferencingRecord of a record, creating it if it does not exist yet.
+
+        :param record: an Invenio Record instance
+        :return an instance of ReferencingRecord
+        """
+        return cls.query.get(cls.get_or_create_id(record))
+
+    @classmethod
+    def get_or_create_id(cls, record):
+        """
+        Return id of a ReferencingRecord of a record, creating it if it does not exist yet.
+
+        The row is upserted, so concurrent writers of the same record do not conflict.
+
+        :param record: an Invenio Record instance
+        :return id of the ReferencingRecord
+        """
+        class_id = ClassName.get_id(str(class_import_string(record)))
+        return _get_or_insert_id(cls, 'record_uuid',
+                                 dict(record_uuid=record.id, class_id=class_id))[0]
+
+    @classmethod
+    def get_or_create_ids(cls, records):
+        """
+        Return ids of ReferencingRecords of records, creating the missing ones.
+
+        The missing rows are upserted by a single statement, so concurrent writers
+        of the same records do not conflict.
+
+        :param records: a list of Invenio Record instances
+        :return dict of record UUID -> id of its ReferencingRecord
+        """
+        # records without an id can not be looked up in bulk
+        ids = {record.id: cls.get_or_create_id(record) for record in records
+               if record.id is None}
+        ids.update(db.session.query(cls.record_uuid, cls.id)
+                   .filter(cls.record_uuid.in_([record.id for record in records])))
+        missing = [record for record in records if record.id not in ids]
+        if missing:
+            _insert_ignoring_conflicts(cls.__table__, [
+                dict(record_uuid=record.id,
+                     class_id=ClassName.get_id(str(class_import_string(record))))
+                for record in missing
+            ], ['record_uuid'])
+            ids.update(db.session.query(cls.record_uuid, cls.id)
+                       .filter(cls.record_uuid.in_([record.id for record in missing])))
+        return ids
+
     id = db.Column(Integer, primary_key=True)
     record_uuid = db.Column(
         UUIDType,
@@ -110,86 +337,237 @@ class RecordReference(db.Model, Timestamp):
                  record: ReferencingRecord,
                  reference: str,
                  reference_uuid: uuid.UUID,
-                 inline: bool):
+                 inline: bool,
+                 content_digest: str = None,
+                 json_paths: list = None):
         """Initialize record reference instance.
 
         :param record: instance of a referencing Invenio record
         :param reference: URL of a referenced object
         :param reference_uuid: UUID of a referenced object (optional)
         :param inline: Referenced object data inlined into referencing record?
+        :param content_digest: Digest of the inlined data (optional)
+        :param json_paths: JSON pointers of the reference in the referencing record (optional)
         """
         self.record = record
         self.reference = reference
         self.reference_uuid = reference_uuid
         self.inline = inline
+        self.content_digest = content_digest
+        self.json_paths = json_paths
 
     @classmethod
-    def create(cls, record: Record, reference, reference_uuid, inline=False, raise_on_duplicit=True):
+    def create(cls, record: Record, reference, reference_uuid, inline=False,
+               raise_on_duplicit=True, content_digest=None, json_paths=None):
         """Creates a new Reference Record.
 
         :param record: an Invenio Record instance
         :param reference: URL reference to the referenced object
         :param reference_uuid: UUID of the referenced object
         :param inline: is referenced object data inlined into the referencing record?
+        :param content_digest: digest of the inlined data
+        :param json_paths: JSON pointers of the reference in the referencing record
         :return: an instance of the created RecordReference
         """
-        if RecordReference.query \
-            .join(ReferencingRecord, aliased=True) \
-            .filter(ReferencingRecord.record_uuid == record.id) \
-            .filter(RecordReference.reference == reference).count() > 0:
+        record_id = ReferencingRecord.get_or_create_id(record)
+        ref_id = uuid.uuid4()
+        table = cls.__table__
+        inserted = _insert_ignoring_conflicts(
+            table,
+            dict(
+                id=ref_id,
+                record_id=record_id,
+                reference=reference,
+                reference_uuid=reference_uuid,
+                inline=inline,
+                content_digest=content_digest,
+                json_paths=json_paths,
+                version_id=1
+            ),
+            ['record_id', 'reference'],
+            returning=table.c.id)
+        if inserted is None:
+            inserted = [v for v, in db.session.query(cls.id).filter_by(id=ref_id)]
+        if not inserted:
             if raise_on_duplicit:
-                raise IntegrityError('Error creating reference record - already exists', '', [], None)
+                raise IntegrityError('Error creating reference record - already exists',
+                                     '', [], None)
             return None
-        with db.session.begin_nested():
-            reccls = str(class_import_string(record))
-            try:
-                cn = ClassName.query.filter_by(name=reccls).one()
-            except NoResultFound:
-                cn = ClassName.create(reccls)
+        return cls.query.get(ref_id)
 
-            try:
-                rr = ReferencingRecord.query.filter_by(record_uuid=record.id).one()
-            except NoResultFound:
-                rr = ReferencingRecord.create(record.id, cn)
-
-            ret = cls(
-                record=rr,
-                reference=reference,
-                reference_uuid=reference_uuid,
-                inline=inline)
+    @classmethod
+    def get_reference_specs(cls, record_uuid):
+        """Return reference specs of the stored references of a record.
 
-            db.session.add(ret)
-            return ret
+        :param record_uuid: UUID of the referencing record
+        :return: a list of reference specs, as accepted by :meth:`update_references`
+        """
+        rows = db.session.query(cls.reference, cls.reference_uuid, cls.inline,
+                                cls.content_digest, cls.json_paths) \
+            .join(ReferencingRecord, cls.record_id == ReferencingRecord.id) \
+            .filter(ReferencingRecord.record_uuid == record_uuid)
+        return [
+            dict(reference=reference, reference_uuid=reference_uuid, inline=inline,
+                 content_digest=digest, json_paths=paths)
+            for reference, reference_uuid, inline, digest, paths in rows
+        ]
 
     @classmethod
     def update_references(cls, record, references):
+        """Synchronize references of a record with the given reference specs.
+
+        The number of issued statements does not depend on the number
+        of changed references, see :meth:`update_references_many`.
+
+        :param record: an Invenio Record instance
+        :param references: a list of reference specs (dicts with ``reference``,
+                           ``reference_uuid``, ``inline``, ``content_digest``
+                           and ``json_paths`` keys)
+        """
+        cls.update_references_many([(record, references)])
+
+    @classmethod
+    def update_references_many(cls, items):
+        """Synchronize references of several records with the given reference specs.
 
-        refs = {}
-        for ref in (references or []):
-            refs[ref['reference']] = ref
+        The number of issued statements depends neither on the number of records
+        nor on the number of changed references: existing references are fetched
+        by a single query, new references are stored by one bulk insert, content digests
+        and JSON paths of changed references are updated by one bulk update and obsolete
+        references are removed by one bulk delete.
 
-        refs_set = set(refs.keys())
+        .. note::
 
-        existing_refs = set(
-            ref.reference
-            for ref in RecordReference.query \
-                .join(ReferencingRecord, aliased=True) \
-                .filter(ReferencingRecord.record_uuid == record.id)
-        )
+           Bulk statements bypass the ORM unit of work, so no SQLAlchemy-Continuum
+           versions are recorded for the inserted, updated and deleted rows.
 
-        new_refs = refs_set - existing_refs
-        obsolete_refs = existing_refs - refs_set
+        :param items: an iterable of (Invenio Record instance, list of reference specs)
+                      tuples, reference specs are dicts with ``reference``,
+                      ``reference_uuid``, ``inline``, ``content_digest``
+                      and ``json_paths`` keys
+        """
+        records = OrderedDict()
+        record_refs = {}
+        for record, references in items:
+            refs = {}
+            for ref in (references or []):
+                ref = dict(ref)
+                previous = refs.get(ref['reference'])
+                if previous and previous.get('inline', False) != ref.get('inline', False):
+                    # inlined and linked at once, the reference is stored as inlined
+                    # with paths of the inlined content only, links are never replaced by it
+                    if not ref.get('inline', False):
+                        continue
+                elif previous and (previous.get('json_paths') or ref.get('json_paths')):
+                    # the same reference occurs on several places in the record
+                    ref['json_paths'] = sorted(
+                        set(previous.get('json_paths') or []) | set(ref.get('json_paths') or []))
+                refs[ref['reference']] = ref
+            records[record.id] = record
+            record_refs[record.id] = refs
+        if not records:
+            return
+
+        rows = db.session.query(ReferencingRecord.record_uuid,
+                                ReferencingRecord.id,
+                                RecordReference.id,
+                                RecordReference.reference,
+                                RecordReference.content_digest,
+                                RecordReference.json_paths) \
+            .outerjoin(RecordReference, RecordReference.record_id == ReferencingRecord.id) \
+            .filter(ReferencingRecord.record_uuid.in_(list(records))) \
+            .all()
+
+        record_ids = {}
+        existing = defaultdict(dict)
+        for record_uuid, record_id, ref_id, ref, digest, paths in rows:
+            record_ids[record_uuid] = record_id
+            if ref is not None:
+                existing[record_uuid][ref] = (ref_id, digest, paths)
+
+        new_refs = []
+        changed_refs = []
+        obsolete_ids = set()
+        for record_uuid, refs in record_refs.items():
+            record_existing = existing.get(record_uuid, {})
+            new_refs.extend((record_uuid, ref_key) for ref_key in refs
+                            if ref_key not in record_existing)
+            obsolete_ids.update(ref_id for ref_key, (ref_id, _, _) in record_existing.items()
+                                if ref_key not in refs)
+            changed_refs.extend(
+                dict(_id=record_existing[ref_key][0],
+                     content_digest=ref.get('content_digest'),
+                     json_paths=ref.get('json_paths'))
+                for ref_key, ref in refs.items()
+                if ref_key in record_existing and
+                (ref.get('content_digest'), ref.get('json_paths')) !=
+                record_existing[ref_key][1:]
+            )
+
+        if new_refs:
+            missing = [records[record_uuid] for record_uuid in records
+                       if record_uuid not in record_ids]
+            if missing:
+                record_ids.update(ReferencingRecord.get_or_create_ids(missing))
+
+            # references stored by a concurrent writer of the same record are skipped
+            _insert_ignoring_conflicts(
+                cls.__table__,
+                [
+                    dict(
+                        id=uuid.uuid4(),
+                        record_id=record_ids[record_uuid],
+                        reference=ref_key,
+                        reference_uuid=record_refs[record_uuid][ref_key].get('reference_uuid'),
+                        inline=record_refs[record_uuid][ref_key].get('inline', False),
+                        content_digest=record_refs[record_uuid][ref_key].get('content_digest'),
+                        json_paths=record_refs[record_uuid][ref_key].get('json_paths'),
+                        version_id=1
+                    ) for record_uuid, ref_key in new_refs
+                ],
+                ['record_id', 'reference']
+            )
+
+        if changed_refs:
+            table = cls.__table__
+            db.session.execute(
+                table.update()
+                .where(table.c.id == bindparam('_id'))
+                .values(content_digest=bindparam('content_digest'),
+                        json_paths=bindparam('json_paths'),
+                        version_id=table.c.version_id + 1),
+                changed_refs
+            )
+
+        if obsolete_ids:
+            RecordReference.query \
+                .filter(RecordReference.id.in_(list(obsolete_ids))) \
+                .delete(synchronize_session=False)
+
+        if new_refs or obsolete_ids or changed_refs:
+            cls.expire_loaded_references(record_ids.values(), obsolete_ids)
+
+    @classmethod
+    def expire_loaded_references(cls, record_ids, deleted_ids=()):
+        """
+        Expire references of ReferencingRecords loaded before bulk statements changed them.
 
-        for ref_key in new_refs:
-            RecordReference.create(record, **refs[ref_key])
+        Flushing stale objects would fail on their outdated version ids.
 
-        if obsolete_refs:
-            for x in \
-                RecordReference.query \
-                    .join(ReferencingRecord, aliased=True) \
-                    .filter(ReferencingRecord.record_uuid == record.id) \
-                    .filter(RecordReference.reference.in_(obsolete_refs)):
-                db.session.delete(x)
+        :param record_ids: ids of ReferencingRecords whose references have been changed
+        :param deleted_ids: ids of references that have been deleted
+        """
+        record_ids = set(record_ids)
+        deleted_ids = set(deleted_ids)
+        for obj in list(db.session.identity_map.values()):
+            if isinstance(obj, RecordReference) and \
+                    obj.__dict__.get('record_id') in record_ids:
+                if obj.__dict__.get('id') in deleted_ids:
+                    db.session.expunge(obj)
+                else:
+                    db.session.expire(obj)
+            elif isinstance(obj, ReferencingRecord) and obj.__dict__.get('id') in record_ids:
+                db.session.expire(obj, ['references'])
 
     id = db.Column(
         UUIDType,
@@ -225,6 +603,18 @@ class RecordReference(db.Model, Timestamp):
         default=False
     )
 
+    content_digest = db.Column(
+        String(64),
+        nullable=True
+    )
+    """Digest of the inlined content of the referenced object"""
+
+    json_paths = db.Column(
+        db.JSON().with_variant(JSONType(), 'sqlite').with_variant(JSONType(), 'mysql'),
+        nullable=True
+    )
+    """JSON pointers of the reference occurrences in the referencing record"""
+
     version_id = db.Column(db.Integer, nullable=False)
     """Used by SQLAlchemy for optimistic concurrency control."""
 
@@ -237,6 +627,24 @@ class RecordReference(db.Model, Timestamp):
         return f'{get_record_object(self)}->{self.reference}'
 
 
+db.Index('ix_oarepo_references_inline_reference',
+         RecordReference.reference,
+         postgresql_where=RecordReference.inline.is_(True),
+         sqlite_where=RecordReference.inline.is_(True))
+"""Partial index of inlined references, used when propagating inlined content."""
+
+db.Index('ix_oarepo_references_inline_reference_uuid',
+         RecordReference.reference_uuid,
+         postgresql_where=RecordReference.inline.is_(True),
+         sqlite_where=RecordReference.inline.is_(True))
+"""Partial index of inlined references by the referenced record UUID."""
+
+db.Index('ix_oarepo_references_reference_pattern',
+         RecordReference.reference,
+         postgresql_ops={'reference': 'varchar_pattern_ops'})
+"""Index of references usable by prefix (``LIKE 'prefix%'``) lookups under any collation."""
+
+
 __all__ = (
     'RecordReference',
     'ReferencingRecord',
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Miroslav Bauer, CESNET.
+#
+# oarepo-references is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License; see LICENSE file for more details.
+
+"""OArepo module for tracking and updating references in Invenio records."""
+
+from __future__ import absolute_import, print_function
+
+import logging
+import uuid
+from collections import defaultdict
+
+from flask import current_app, g
+from invenio_base.utils import obj_or_import_string
+from invenio_db import db
+from invenio_records import Record
+
+from oarepo_references.models import ClassName
+
+log = logging.getLogger(__name__)
+
+
+class _Origin(object):
+    """Graph node of a changed reference that is not a known record."""
+
+    def __init__(self, url):
+        """Initialize the node of a reference URI."""
+        self.url = url
+
+    def __eq__(self, other):
+        """Nodes of the same reference URI are equal."""
+        return isinstance(other, _Origin) and self.url == other.url
+
+    def __hash__(self):
+        """Hash of the reference URI."""
+        return hash(self.url)
+
+    def __repr__(self):
+        """Node representation string."""
+        return f'<changed reference {self.url}>'
+
+
+def _origin_node(change):
+    """Return the graph node of a changed reference."""
+    if change.get('uuid') is not None:
+        return uuid.UUID(str(change['uuid']))
+    return _Origin(change['url'])
+
+
+def _revision(content):
+    """Return the revision of a changed content, -1 if it is not a Record."""
+    revision_id = getattr(content, 'revision_id', None)
+    return -1 if revision_id is None else revision_id
+
+
+def is_propagating():
+    """Return True if a propagation of inlined reference content is in progress."""
+    return getattr(g, 'oarepo_references_propagating', False)
+
+
+class ReferencePropagation(object):
+    """Propagation of changed reference contents to all records inlining them.
+
+    Records referencing the changed reference by link only are skipped,
+    as they hold no inlined data to update, and so are records whose
+    inlined data digest matches the digest of the changed content.
+    The affected records are collected transitively (records inlining
+    a record that inlines the changed reference etc.) and ordered topologically,
+    so that every record is committed at most once, after all the records
+    it inlines have been updated, with all the changes of the references it inlines.
+    References closing a cycle are not followed and the changed references
+    themselves are not updated.
+
+    Only ids of the affected records are collected, the records are then locked,
+    loaded and updated chunk by chunk in the topological order.
+    """
+
+    def __init__(self, api, changes, max_depth=None, patch=False, commit=False):
+        """Initialize the propagation.
+
+        :param api: RecordReferenceAPI used to look up and lock referrers
+        :param changes: A list of changed references, dicts with the changed ``content``
+                        and the reference ``url`` and/or the ``uuid`` of a referenced Record
+        :param max_depth: Maximal distance of an updated record from a changed
+                          reference, None for no limit
+        :param patch: Replace the inlined contents at their stored JSON paths
+                      instead of revalidating the whole records
+        :param commit: Commit the database transaction after every chunk of updated records
+        """
+        self.api = api
+        self.max_depth = max_depth
+        self.patch = patch
+        self.commit = commit
+
+        self.origins = {}
+        self.contents = {}
+        self.digests = {}
+        self.urls = {}
+        for change in changes:
+            node = _origin_node(change)
+            if node in self.origins and \
+                    _revision(self.contents[node]) > _revision(change['content']):
+                # the latest change of a reference wins, the last one of the same revision
+                continue
+            self.origins[node] = None
+            self.contents[node] = change['content']
+            self.urls[node] = change.get('url')
+        self.visited = set()
+        self.classes = {}
+        self.referrers = defaultdict(list)
+        self.edges = defaultdict(list)
+
+    def run(self):
+        """Propagate the changed content.
+
+        :returns: A list of updated Records in the order they were committed,
+                  a list of their UUIDs if the transaction is committed chunk by chunk
+        """
+        previous = is_propagating()
+        g.oarepo_references_propagating = True
+        try:
+            self.collect()
+            updated = self.propagate(*self.order())
+            if self.commit:
+                return [node for node, _ in updated]
+            return [rec for _, rec in updated]
+        finally:
+            g.oarepo_references_propagating = previous
+
+    def collect(self):
+        """Collect ids of all records affected by the change, level by level.
+
+        Referrers of a level are looked up in chunks, records of the level are loaded
+        just to find out their reference URIs, the referrers of the next level refer to.
+        """
+        level = list(self.origins)
+        urls = dict(self.urls)
+        depth = 0
+        while level and (self.max_depth is None or depth < self.max_depth):
+            depth += 1
+            to_load = defaultdict(list)
+            for node, row in self.referrers_of(level, urls):
+                if row.record_uuid in self.origins:
+                    log.debug('References: changed reference %s inlines %s, not propagating',
+                              row.record_uuid, row.reference)
+                    continue
+                if node in self.origins and self.is_inlined(node, row):
+                    # the referrer has already inlined the same content
+                    continue
+                if (node, row.record_uuid) not in self.edges:
+                    self.referrers[node].append(row.record_uuid)
+                self.edges[(node, row.record_uuid)].append((row.reference, row.json_paths))
+                if row.record_uuid not in self.classes:
+                    self.classes[row.record_uuid] = row.class_id
+                    to_load[row.class_id].append(row.record_uuid)
+
+            level = []
+            urls = {}
+            for rec in self.api.load_referrers(to_load):
+                self.visited.add(rec.id)
+                urls[rec.id] = getattr(rec, 'canonical_url', None)
+                level.append(rec.id)
+
+    def is_inlined(self, node, row):
+        """Return True if a referrer has already inlined the changed content of a node.
+
+        The digest of the content is computed for every JSON path of the reference
+        by the referrer record class, as it would be stored by the referrer.
+
+        :param node: A changed reference graph node
+        :param row: A referrer row, as returned by the ``iter_referrers`` API
+        """
+        if row.content_digest is None or not row.json_paths:
+            return False
+        for path in row.json_paths:
+            key = (node, row.class_id, path)
+            if key not in self.digests:
+                rec_cls = obj_or_import_string(ClassName.get_name(row.class_id), Record)
+                inlined_content_digest = getattr(rec_cls, 'inlined_content_digest', None)
+                self.digests[key] = inlined_content_digest(path, self.contents[node]) \
+                    if inlined_content_digest else None
+            if self.digests[key] != row.content_digest:
+                return False
+        return True
+
+    def referrers_of(self, nodes, urls):
+        """Look up records inlining any of the nodes, a chunk of nodes at a time.
+
+        :param nodes: A list of graph nodes
+        :param urls: A dict of graph node -> reference URI of the node
+        :returns: A generator of (node, referrer row) tuples
+        """
+        chunk_size = current_app.config['OAREPO_REFERENCES_CHUNK_SIZE']
+        for i in range(0, len(nodes), chunk_size):
+            chunk = nodes[i:i + chunk_size]
+            by_url = {urls[node]: node for node in chunk if urls.get(node)}
+            by_uuid = {node: node for node in chunk if isinstance(node, uuid.UUID)}
+            for rows in self.api.iter_referrers(by_url, inline=True, reference_uuids=by_uuid):
+                for row in rows:
+                    yield by_uuid.get(row.reference_uuid) or by_url[row.reference], row
+
+    def order(self):
+        """Order the collected records topologically.
+
+        :returns: A tuple of an ordered list of record UUIDs
+                  and a set of edges closing a cycle
+        """
+        order = []
+        back_edges = set()
+        state = {}
+        for origin in self.origins:
+            if origin in state:
+                continue
+            state[origin] = 'open'
+            stack = [(origin, iter(self.referrers[origin]))]
+            while stack:
+                node, referrers = stack[-1]
+                for referrer in referrers:
+                    if referrer not in self.visited:
+                        continue
+                    if referrer not in state:
+                        state[referrer] = 'open'
+                        stack.append((referrer, iter(self.referrers[referrer])))
+                        break
+                    if state[referrer] == 'open':
+                        log.warning('References: reference cycle detected between %s and %s',
+                                    referrer, node)
+                        back_edges.add((node, referrer))
+                else:
+                    stack.pop()
+                    state[node] = 'closed'
+                    order.append(node)
+
+        order.reverse()
+        return [node for node in order if node not in self.origins], back_edges
+
+    def content(self, node, records):
+        """Return the changed content of a node.
+
+        :param node: A changed reference graph node
+        :param records: Records of the chunk being updated, keyed by their UUIDs,
+                        records updated by previous chunks are loaded again
+        """
+        if node in self.origins:
+            return self.contents[node]
+        if node not in records:
+            rec_cls = obj_or_import_string(ClassName.get_name(self.classes[node]), Record)
+            records[node] = rec_cls.get_record(node)
+        return records[node]
+
+    def propagate(self, order, back_edges):
+        """Commit every ordered record once with all its changed inlined references.
+
+        Records are locked and updated in chunks, with ``commit`` the transaction
+        is committed after every chunk.
+
+        :param order: Record UUIDs in topological order
+        :param back_edges: Edges closing a cycle that are not followed
+        :returns: A generator of (record UUID, updated Record) tuples
+        """
+        inlined = defaultdict(list)
+        for node, referrers in self.referrers.items():
+            for referrer in referrers:
+                if (node, referrer) not in back_edges:
+                    inlined[referrer].append(node)
+
+        chunk_size = current_app.config['OAREPO_REFERENCES_LOCK_CHUNK_SIZE']
+        for i in range(0, len(order), chunk_size):
+            chunk = order[i:i + chunk_size]
+            to_lock = defaultdict(list)
+            for node in chunk:
+                to_lock[self.classes[node]].append(node)
+            records = {rec.id: rec for rec in self.api.lock_referrers(to_lock)}
+
+            updated = []
+            for node in chunk:
+                rec = records.get(node)
+                if rec is None:
+                    # deleted since the referrers have been collected
+                    continue
+                changes = [
+                    dict(
+                        url=url,
+                        uuid=ref if isinstance(ref, uuid.UUID) else None,
+                        content=self.content(ref, records),
+                        paths=paths
+                    ) for ref in inlined[node] for url, paths in self.edges[(ref, node)]
+                ]
+                if self.patch and all(change['paths'] for change in changes):
+                    rec.patch_inlined_refs(changes)
+                elif len(changes) == 1:
+                    rec.update_inlined_ref(changes[0]['url'], changes[0]['uuid'],
+                                           changes[0]['content'])
+                else:
+                    rec.update_inlined_refs(changes)
+                updated.append((node, rec))
+
+            if self.commit:
+                db.session.commit()
+            yield from updated
+
+
+__all__ = (
+    'ReferencePropagation',
+    'is_propagating'
+)
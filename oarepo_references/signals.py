@@ -10,13 +10,17 @@
 from __future__ import absolute_import, print_function
 
 from blinker import Namespace
+from flask import current_app
 from invenio_db import db
 from invenio_records.signals import after_record_delete, after_record_insert, \
     after_record_update
 from oarepo_validate import before_marshmallow_validate, after_marshmallow_validate
 
 from oarepo_references.models import RecordReference
+from oarepo_references.propagation import is_propagating
 from oarepo_references.proxies import current_references
+from oarepo_references.tasks import schedule_reference_content_changed
+from oarepo_references.utils import resolve_reference_paths
 
 _signals = Namespace()
 
@@ -26,7 +30,12 @@ after_reference_update = _signals.signal('after-reference-update')
 When implementing the event listener, the referencing record ids
 can retrieved from `kwarg['references']`, the referenced object
 can be retrieved from `sender`, the referenced record can be retrieved
-from `kwarg['record']`.
+from `kwarg['record']`. The signal is sent for every chunk of referencing
+records, so that their ids are not collected all at once.
+
+When reindexing is deferred until a transaction commits, the signal is sent
+once per transaction, `sender` and `kwarg['ref_obj']` are then lists
+of all changed references and referenced objects.
 
 .. note::
 
@@ -45,7 +54,10 @@ def set_references_to_context(sender, context, **kwargs):
 @after_marshmallow_validate.connect
 def set_references_from_context(sender, record, context, result, **kwargs):
     """A signal receiver to set record references from validation context."""
-    record.oarepo_references = context.get('references', [])
+    references = context.get('references', [])
+    if isinstance(result, dict):
+        resolve_reference_paths(result, references)
+    record.oarepo_references = references
     return record
 
 
@@ -66,7 +78,15 @@ def update_references_record(sender, record, *args, **kwargs):
 
     with db.session.begin_nested():
         RecordReference.update_references(record, record.oarepo_references)
-        return current_references.reference_content_changed(record, record.canonical_url)
+        if is_propagating():
+            # the record has been committed by a running propagation,
+            # which takes care of records inlining it as well
+            return []
+        if current_app.config['OAREPO_REFERENCES_PROPAGATION_ASYNC']:
+            schedule_reference_content_changed(record, record.canonical_url)
+            return []
+        return current_references.reference_content_changed(
+            record, record.canonical_url, record.id)
 
 
 @after_record_delete.connect
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Miroslav Bauer, CESNET.
+#
+# oarepo-references is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License; see LICENSE file for more details.
+
+"""OArepo module for tracking and updating references in Invenio records."""
+
+from __future__ import absolute_import, print_function
+
+import logging
+
+from celery import shared_task, signature
+from flask import current_app
+from invenio_base.utils import obj_or_import_string
+from invenio_db import db
+from invenio_records import Record
+from sqlalchemy.orm.exc import NoResultFound
+
+from oarepo_references.proxies import current_references
+from oarepo_references.utils import TransactionState, _run_task_on_referrer_ids, \
+    class_import_string
+
+log = logging.getLogger(__name__)
+
+
+def schedule_reference_content_changed(record, ref_url):
+    """
+    Queue a deferred propagation of a changed record content once the current transaction commits.
+
+    Repeated changes of the record within a transaction queue a single task
+    for the latest revision. The task is delayed by ``OAREPO_REFERENCES_PROPAGATION_COUNTDOWN``
+    seconds, tasks of repeated changes of the record within this window are skipped
+    except the last one, which propagates the latest content.
+    Changes rolled back with a savepoint do not replace the changes scheduled before it.
+
+    :param record: the changed Record
+    :param ref_url: Reference URI of the record
+    """
+    _scheduled_propagation[str(record.id)] = dict(
+        record_uuid=str(record.id),
+        record_class=class_import_string(record),
+        ref_url=ref_url,
+        revision_id=record.revision_id
+    )
+
+
+def _queue_scheduled_propagation(session, pending):
+    """Queue propagations scheduled by a committed transaction."""
+    for kwargs in pending.values():
+        propagate_reference_content.apply_async(
+            kwargs=kwargs,
+            countdown=current_app.config['OAREPO_REFERENCES_PROPAGATION_COUNTDOWN']
+        )
+
+
+_scheduled_propagation = TransactionState('oarepo_references_propagate',
+                                          _queue_scheduled_propagation)
+"""Propagations scheduled in the current transaction, keyed by the changed record UUID."""
+
+
+@shared_task(ignore_result=True)
+def propagate_reference_content(record_uuid, record_class, ref_url, revision_id):
+    """
+    Propagate the content of a changed record to the records inlining it.
+
+    The task is queued after the change has been committed, tasks of outdated
+    revisions and of records that are gone are skipped.
+
+    :param record_uuid: UUID of the changed Record
+    :param record_class: import string of the changed Record class
+    :param ref_url: Reference URI of the changed Record
+    :param revision_id: revision of the Record the task has been queued for
+    """
+    rec_cls = obj_or_import_string(record_class, Record)
+    try:
+        rec = rec_cls.get_record(record_uuid)
+    except NoResultFound:
+        log.info('References: record %s is gone, not propagating its content', record_uuid)
+        return
+
+    if rec.revision_id != revision_id:
+        # the task is outdated, the task of the latest change propagates its content
+        log.debug('References: revision %s of record %s is not current, not propagating',
+                  revision_id, record_uuid)
+        return
+
+    current_references.reference_content_changed(rec, ref_url, rec.id, commit=True)
+    db.session.commit()
+
+
+@shared_task
+def run_task_on_referrer_ids(reference, task, success_task=None, error_task=None,
+                             chunk_size=None, after=None):
+    """
+    Queue tasks on the next chunk of referrers of a reference.
+
+    See :func:`oarepo_references.utils.run_task_on_referrers` with ``ids_only``.
+
+    :param after: id of the last reference record of the previous chunk
+    """
+    return _run_task_on_referrer_ids(
+        reference,
+        signature(task),
+        signature(success_task) if success_task else None,
+        signature(error_task) if error_task else None,
+        chunk_size,
+        after=after
+    )
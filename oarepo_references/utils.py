@@ -3,13 +3,23 @@
 
 from __future__ import absolute_import, print_function
 
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
 from urllib.parse import urlsplit
 
-from celery import chain
+from celery import chain, group
 from flask import current_app
 from invenio_base.utils import obj_or_import_string
+from invenio_db import db
+from invenio_pidstore import current_pidstore
+from invenio_pidstore.models import PersistentIdentifier
 from invenio_records import Record
-from invenio_records_rest.errors import PIDRESTException
+from invenio_records.models import RecordMetadata
+from sqlalchemy import event, inspect
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.exceptions import NotFound
 
@@ -21,30 +31,108 @@ def class_import_string(o):
     return f'{o.__class__.__module__}.{o.__class__.__qualname__}'
 
 
-def run_task_on_referrers(reference, task, success_task=None, error_task=None):
+def content_digest(data):
+    """Returns a digest of a json-friendly data, independent on the order of keys."""
+    serialized = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def json_pointer(path):
+    """Returns a JSON pointer (RFC 6901) of a path given as a sequence of keys and indices."""
+    return ''.join('/' + str(p).replace('~', '~0').replace('/', '~1') for p in path)
+
+
+def _walk_json(data, path=()):
+    """Yields (path, value) tuples of all values in a json-friendly data."""
+    yield path, data
+    if isinstance(data, dict):
+        for k, v in data.items():
+            yield from _walk_json(v, path + (k,))
+    elif isinstance(data, (list, tuple)):
+        for idx, v in enumerate(data):
+            yield from _walk_json(v, path + (idx,))
+
+
+class LinkValue(str):
+    """A reference by link deserialized by a link field, located in the data by its identity.
+
+    Replaced by a plain string once its JSON path has been resolved.
+    """
+
+
+def resolve_reference_paths(data, references):
+    """
+    Sets ``json_paths`` of reference specs to JSON pointers of the references in data.
+
+    Inlined references are located by the identity of their validated data,
+    references by link by the identity of the :class:`LinkValue` deserialized
+    by their link field, so that only positions of the registering field are recorded.
+
+    :param data: validated record data
+    :param references: a list of reference specs registered during the validation
+    """
+    by_identity = defaultdict(list)
+    links = []
+    for path, value in _walk_json(data):
+        if isinstance(value, (dict, LinkValue)):
+            by_identity[id(value)].append(json_pointer(path))
+        if isinstance(value, LinkValue):
+            links.append(path)
+
+    for ref in references:
+        ref_data = ref.pop('_data', None)
+        ref['json_paths'] = by_identity.get(id(ref_data)) if ref_data is not None else None
+
+    for path in links:
+        parent = data
+        for key in path[:-1]:
+            parent = parent[key]
+        parent[path[-1]] = str(parent[path[-1]])
+
+
+def run_task_on_referrers(reference, task, success_task=None, error_task=None,
+                          ids_only=False, chunk_size=None):
     """
     Queues a task for all referrers referring the given reference.
 
+    By default, the referrers are processed one after another and each task
+    gets the whole referring record in its ``record`` argument.
+    With ``ids_only``, tasks get just the ``record_uuid`` of a referrer
+    and are dispatched in groups of ``chunk_size`` tasks running in parallel,
+    group by group as the referrers are looked up chunk by chunk.
+    The success task then gets the ``reference`` and ``record_uuids`` of the referrers
+    instead of ``records``, the UUIDs are looked up once the last group has been queued.
+
     :param reference: reference for which to run the tasks on referrers
     :param task: a celery signature
     :param success_task: a celery signature to handle success of task chain
     :param error_task: a celery signature to handle error of a certain task
+    :param ids_only: pass referrer UUIDs instead of records to the tasks
+    :param chunk_size: number of tasks in a group,
+                       defaults to ``OAREPO_REFERENCES_TASK_CHUNK_SIZE``
     """
-    refs = current_references.get_records(reference)
+    if ids_only:
+        return _run_task_on_referrer_ids(reference, task, success_task, error_task, chunk_size)
 
     task_list = []
     rec_list = []
 
-    for ref in refs:
-        rec = Record.get_record(id_=ref.record.record_uuid)
-        # Add the referencing record to the task signature
-        record_task = task.clone(kwargs={'record': rec})
-        if error_task:
-            record_error = error_task.clone(kwargs={'record': rec})
-            record_task = record_task.on_error(record_error)
+    for refs in current_references.iter_records(reference):
+        records = {
+            rec.id: rec for rec in Record.get_records([ref.record.record_uuid for ref in refs])
+        }
+        for ref in refs:
+            rec = records.get(ref.record.record_uuid)
+            if rec is None:
+                continue
+            # Add the referencing record to the task signature
+            record_task = task.clone(kwargs={'record': rec})
+            if error_task:
+                record_error = error_task.clone(kwargs={'record': rec})
+                record_task = record_task.on_error(record_error)
 
-        task_list.append(record_task)
-        rec_list.append(rec)
+            task_list.append(record_task)
+            rec_list.append(rec)
 
     job = chain(
         *task_list
@@ -56,25 +144,312 @@ def run_task_on_referrers(reference, task, success_task=None, error_task=None):
     return job_result
 
 
+def _run_task_on_referrer_ids(reference, task, success_task, error_task, chunk_size,
+                              after=None):
+    """
+    Queues a group of tasks getting UUIDs of the next chunk of referrers of the given reference.
+
+    The group is chained with a task queueing the following chunk, so that referrers
+    are never collected all at once.
+
+    :param after: id of the last reference record of the previous chunk
+    """
+    from oarepo_references.tasks import run_task_on_referrer_ids
+
+    chunk_size = chunk_size or current_app.config['OAREPO_REFERENCES_TASK_CHUNK_SIZE']
+    refs = next(current_references.iter_records(reference, chunk_size=chunk_size, after=after),
+                [])
+
+    jobs = []
+    # referrers that have been deleted are skipped
+    record_uuids = [str(v) for v, in db.session.query(RecordMetadata.id).filter(
+        RecordMetadata.id.in_([ref.record.record_uuid for ref in refs]),
+        RecordMetadata.json.isnot(None)
+    )] if refs else []
+    if record_uuids:
+        record_tasks = []
+        for record_uuid in record_uuids:
+            # immutable, so that results of a previous group are not passed to the tasks
+            record_task = task.clone(kwargs={'record_uuid': record_uuid}).set(immutable=True)
+            if error_task:
+                record_task = record_task.on_error(
+                    error_task.clone(kwargs={'record_uuid': record_uuid}))
+            record_tasks.append(record_task)
+        jobs.append(group(*record_tasks))
+
+    if len(refs) == chunk_size:
+        jobs.append(run_task_on_referrer_ids.si(reference, task, success_task, error_task,
+                                                chunk_size=chunk_size, after=str(refs[-1].id)))
+    elif success_task:
+        referrer_uuids = [str(v) for record_uuids in current_references.iter_referrer_ids(
+            reference, chunk_size=chunk_size) for v in record_uuids]
+        jobs.append(success_task.clone(kwargs={
+            'reference': reference,
+            'record_uuids': referrer_uuids
+        }).set(immutable=True))
+    if not jobs:
+        return None
+    return chain(*jobs).apply_async()
+
+
+def build_endpoint_index(endpoints):
+    """
+    Returns REST endpoints indexed by their PID type.
+
+    Endpoints with a default endpoint prefix come first, otherwise endpoints
+    keep their configured order.
+
+    :param endpoints: REST endpoints configuration, e.g. ``RECORDS_REST_ENDPOINTS``
+    :return: dict of pid_type -> list of (endpoint name, endpoint) tuples
+    """
+    index = defaultdict(list)
+    # sorting is stable, so endpoints keep their configured order within a group
+    ordered = sorted(endpoints.items(),
+                     key=lambda item: not item[1].get('default_endpoint_prefix', False))
+    for endpoint_name, endpoint in ordered:
+        index[endpoint.get('pid_type')].append((endpoint_name, endpoint))
+    return dict(index)
+
+
+RESOLVED_ENDPOINT_PROPS = ('pid_minter', 'record_class', 'record_indexer')
+"""Endpoint properties naming a minter or an importable object."""
+
+
+def resolve_endpoint_prop(prop, value):
+    """
+    Returns a value of a REST endpoint property with a minter or an importable
+    object named by it resolved, other values are returned as they are.
+
+    :param prop: name of the endpoint property
+    :param value: configured value of the property
+    """
+    if prop not in RESOLVED_ENDPOINT_PROPS or not isinstance(value, str):
+        return value
+    if prop == 'pid_minter':
+        return current_pidstore.minters[value]
+    return obj_or_import_string(value)
+
+
 def get_record_object(rec_ref):
     """Fetches an instance of a Record from a certain reference record."""
+    from oarepo_references.models import ClassName
+
     rec = rec_ref.record
-    rec_cls = obj_or_import_string(rec.class_name.name, Record)
+    rec_cls = obj_or_import_string(ClassName.get_name(rec.class_id), Record)
     try:
         return rec_cls.get_record(rec.record_uuid)
     except NoResultFound:
         return None
 
 
-def get_reference_uuid(ref_url):
+def _savepoint_level(transaction):
+    """Return the transaction itself if it is a savepoint or the outermost transaction.
+
+    Otherwise return its closest savepoint or outermost ancestor, as subtransactions
+    are committed or rolled back together with it.
     """
-    Returns a record uuid of the given reference.
+    while transaction.parent is not None and not transaction.nested:
+        transaction = transaction.parent
+    return transaction
 
-    Or None if the referenced object could not be found.
+
+class TransactionState(object):
+    """Entries collected in a database transaction, passed on once the transaction commits.
+
+    Entries are collected per savepoint. Entries of a released savepoint become entries
+    of the enclosing transaction, entries of a rolled back savepoint are dropped, so that
+    the entries collected before the savepoint are kept as they were.
+    Once the outermost transaction commits, its entries are passed to ``on_commit``
+    after the transaction has ended, so that ``on_commit`` may use the session.
+    Entries of a rolled back outermost transaction are dropped.
+
+    :param key: key of the entries in ``session.info``
+    :param on_commit: callable getting the session and an ordered dict of the entries
+                      of a committed transaction
     """
-    if not isinstance(ref_url, str):
-        return None
 
+    def __init__(self, key, on_commit=None):
+        """Initialize the state and listen to the transaction events of ``db.session``."""
+        self.key = key
+        self.on_commit = on_commit
+        event.listen(db.session, 'after_commit', self._commit)
+        event.listen(db.session, 'after_transaction_end', self._end)
+
+    def _layers(self, session=None):
+        """Return a list of [transaction, entries, committed] of the open savepoints."""
+        session = db.session if session is None else session
+        return session.info.setdefault(self.key, [])
+
+    def _entries(self):
+        """Return entries of the innermost savepoint of the current transaction."""
+        session = db.session()
+        layers = self._layers(session)
+        transaction = _savepoint_level(session.transaction)
+        if not layers or layers[-1][0] is not transaction:
+            layers.append([transaction, OrderedDict(), False])
+        return layers[-1][1]
+
+    def __contains__(self, key):
+        """Return True if an entry has been collected in the current transaction."""
+        return any(key in entries for _, entries, _ in self._layers())
+
+    def __setitem__(self, key, value):
+        """Collect an entry, replacing an entry collected before."""
+        self._entries()[key] = value
+
+    def get(self, key, default=None):
+        """Return the latest entry collected in the current transaction."""
+        for _, entries, _ in reversed(self._layers()):
+            if key in entries:
+                return entries[key]
+        return default
+
+    def items(self):
+        """Return (key, entry) tuples of all entries collected in the current transaction."""
+        merged = OrderedDict()
+        for _, entries, _ in self._layers():
+            merged.update(entries)
+        return merged.items()
+
+    def discard(self, key):
+        """Drop an entry from all savepoints of the current transaction."""
+        for _, entries, _ in self._layers():
+            entries.pop(key, None)
+
+    def _commit(self, session):
+        """Mark entries of a committed transaction or a released savepoint."""
+        layers = session.info.get(self.key)
+        if layers and layers[-1][0] is session.transaction:
+            layers[-1][2] = True
+
+    def _end(self, session, transaction):
+        """Pass on or drop entries of an ended transaction or savepoint."""
+        layers = session.info.get(self.key)
+        if not layers or layers[-1][0] is not transaction:
+            return
+        _, entries, committed = layers.pop()
+        if not committed:
+            return
+        if transaction.parent is not None:
+            parent = _savepoint_level(transaction.parent)
+            if layers and layers[-1][0] is parent:
+                layers[-1][1].update(entries)
+            else:
+                layers.append([parent, entries, False])
+        elif self.on_commit is not None:
+            self.on_commit(session, entries)
+
+
+class ReferenceUUIDCache(object):
+    """Process-wide LRU cache of record UUIDs keyed by a reference URL.
+
+    Entries resolved in a transaction are kept in the session until it commits,
+    entries of a changed or deleted persistent identifier are dropped.
+    Changes made by other processes are not seen, so entries expire after ttl seconds.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300, session_key='oarepo_references_reference_uuids'):
+        """Initialize an empty cache holding at most maxsize entries for ttl seconds each."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._uuids = OrderedDict()
+        self._urls = defaultdict(set)
+        self._lock = threading.Lock()
+        self._session_uuids = TransactionState(
+            session_key, lambda session, entries: self.promote(entries))
+
+    def get(self, ref_url):
+        """Return a cached (pid_type, pid_value, record UUID) of a reference URL, or None."""
+        entry = self._session_uuids.get(ref_url)
+        if entry is not None:
+            return entry
+        with self._lock:
+            cached = self._uuids.get(ref_url)
+            if cached is None:
+                return None
+            entry, expires = cached
+            if expires is not None and expires <= time.monotonic():
+                del self._uuids[ref_url]
+                self._drop_url(ref_url, entry)
+                return None
+            self._uuids.move_to_end(ref_url)
+            return entry
+
+    def put(self, ref_url, pid):
+        """Remember a persistent identifier a reference URL has been resolved to."""
+        if self.maxsize:
+            self._session_uuids[ref_url] = (pid.pid_type, pid.pid_value, pid.object_uuid)
+
+    def promote(self, entries):
+        """Move entries of a committed transaction to the process-wide cache."""
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            for ref_url, entry in entries.items():
+                self._uuids[ref_url] = (entry, expires)
+                self._uuids.move_to_end(ref_url)
+                self._urls[entry[:2]].add(ref_url)
+            while len(self._uuids) > self.maxsize:
+                ref_url, (entry, _) = self._uuids.popitem(last=False)
+                self._drop_url(ref_url, entry)
+
+    def invalidate(self, pid_type, pid_value):
+        """Drop entries resolved to a persistent identifier."""
+        for ref_url, entry in list(self._session_uuids.items()):
+            if entry[:2] == (pid_type, pid_value):
+                self._session_uuids.discard(ref_url)
+        with self._lock:
+            for ref_url in self._urls.pop((pid_type, pid_value), ()):
+                self._uuids.pop(ref_url, None)
+
+    def clear(self):
+        """Drop all entries of the process-wide cache."""
+        with self._lock:
+            self._uuids.clear()
+            self._urls.clear()
+
+    def _drop_url(self, ref_url, entry):
+        """Remove an evicted URL from the index of URLs by a persistent identifier."""
+        urls = self._urls.get(entry[:2])
+        if urls is not None:
+            urls.discard(ref_url)
+            if not urls:
+                del self._urls[entry[:2]]
+
+
+reference_uuid_cache = ReferenceUUIDCache()
+"""Cache of record UUIDs resolved by :func:`get_reference_uuid`."""
+
+
+@lru_cache(maxsize=32)
+def _url_matcher(url_map, server_name):
+    """Return an URL map bound to a server name."""
+    return url_map.bind(server_name)
+
+
+@event.listens_for(PersistentIdentifier, 'after_update')
+@event.listens_for(PersistentIdentifier, 'after_delete')
+def _invalidate_reference_uuids(mapper, connection, pid):
+    """Forget record UUIDs of a changed or deleted persistent identifier."""
+    attrs = inspect(pid).attrs
+    # entries are keyed by the previous values of a changed pid_type or pid_value
+    reference_uuid_cache.invalidate(*[(attrs[attr].history.deleted or [getattr(pid, attr)])[0]
+                                      for attr in ('pid_type', 'pid_value')])
+    reference_uuid_cache.invalidate(pid.pid_type, pid.pid_value)
+
+
+@event.listens_for(PersistentIdentifier.__table__, 'after_create')
+@event.listens_for(PersistentIdentifier.__table__, 'after_drop')
+def _reset_reference_uuids(*args, **kwargs):
+    """Forget cached record UUIDs when the PID table is (re)created or dropped."""
+    reference_uuid_cache.clear()
+
+
+def _match_reference(ref_url):
+    """
+    Returns a lazy PID value the given reference URL is routed to.
+
+    Or None if the URL does not point to a record on our server.
+    """
     if hasattr(current_app.wsgi_app, 'mounts') and current_app.wsgi_app.mounts:
         api_app = current_app.wsgi_app.mounts.get('/api', current_app)
     else:
@@ -86,7 +461,7 @@ def get_reference_uuid(ref_url):
         # The referenced resource is not on our server
         return None
 
-    matcher = api_app.url_map.bind(parts.netloc)
+    matcher = _url_matcher(api_app.url_map, parts.netloc)
 
     try:
         if parts.path.startswith('/api'):
@@ -96,12 +471,109 @@ def get_reference_uuid(ref_url):
     except NotFound:
         return None
 
-    if 'pid_value' not in args:
+    return args.get('pid_value')
+
+
+def _resolve_pid(pid, resolver):
+    """
+    Returns a persistent identifier of the object a persistent identifier resolves to.
+
+    Redirects are followed, as by the REST API. Or None if the persistent identifier
+    is deleted, not registered or not assigned to an object of the resolver's type.
+
+    :param pid: a PersistentIdentifier
+    :param resolver: the resolver of the persistent identifier's REST endpoint
+    """
+    seen = set()
+    while pid.is_redirected():
+        if pid.id in seen:
+            return None
+        seen.add(pid.id)
+        pid = pid.get_redirect()
+    if pid.is_deleted() or pid.is_redirected():
+        return None
+    if resolver.registered_only and not pid.is_registered():
+        return None
+    if pid.object_uuid is None or \
+            (resolver.object_type and pid.object_type != resolver.object_type):
+        return None
+    return pid
+
+
+def _resolved_uuid(ref_url, pid, resolver):
+    """Returns the object uuid a persistent identifier resolves to and caches it, or None."""
+    resolved = _resolve_pid(pid, resolver)
+    if resolved is None:
         return None
+    if resolved is pid:
+        # a redirected identifier is not cached, changes of its target would not be noticed
+        reference_uuid_cache.put(ref_url, pid)
+    return resolved.object_uuid
 
-    pid = args['pid_value']
-    try:
-        pid, record = pid.data
-    except PIDRESTException:
+
+def get_reference_uuid(ref_url):
+    """
+    Returns a record uuid of the given reference.
+
+    Or None if the referenced object could not be found.
+    """
+    if not isinstance(ref_url, str):
+        return None
+
+    cached = reference_uuid_cache.get(ref_url)
+    if cached is not None:
+        return cached[2]
+
+    pid = _match_reference(ref_url)
+    if pid is None:
+        return None
+
+    resolver = pid.resolver
+    pid = PersistentIdentifier.query.filter_by(pid_type=resolver.pid_type,
+                                               pid_value=str(pid.value)).one_or_none()
+    if pid is None:
         return None
-    return pid.object_uuid
+    return _resolved_uuid(ref_url, pid, resolver)
+
+
+def get_reference_uuids(ref_urls):
+    """
+    Returns record uuids of many references at once.
+
+    References are grouped by their PID type and each group is resolved
+    by a single query for all its PID values. Redirected PIDs are followed
+    and PIDs are resolved as by :func:`get_reference_uuid`.
+
+    :param ref_urls: iterable of reference URLs
+    :return: dict of reference URL -> record UUID, with only the references
+             pointing to an existing record
+    """
+    uuids = {}
+    resolvers = {}
+    pid_values = defaultdict(lambda: defaultdict(list))
+    for ref_url in set(ref_urls):
+        if not isinstance(ref_url, str):
+            continue
+        cached = reference_uuid_cache.get(ref_url)
+        if cached is not None:
+            uuids[ref_url] = cached[2]
+            continue
+        pid = _match_reference(ref_url)
+        if pid is not None:
+            resolvers[pid.resolver.pid_type] = pid.resolver
+            pid_values[pid.resolver.pid_type][str(pid.value)].append(ref_url)
+
+    chunk_size = current_app.config['OAREPO_REFERENCES_CHUNK_SIZE']
+    for pid_type, urls in pid_values.items():
+        values = list(urls)
+        for start in range(0, len(values), chunk_size):
+            pids = PersistentIdentifier.query.filter(
+                PersistentIdentifier.pid_type == pid_type,
+                PersistentIdentifier.pid_value.in_(values[start:start + chunk_size])
+            )
+            for pid in pids:
+                for ref_url in urls[pid.pid_value]:
+                    record_uuid = _resolved_uuid(ref_url, pid, resolvers[pid_type])
+                    if record_uuid is not None:
+                        uuids[ref_url] = record_uuid
+    return uuids
@@ -77,6 +77,9 @@ setup(
         'invenio_base.api_apps': [
             'oarepo_references = oarepo_references.ext:OARepoReferences',
         ],
+        'invenio_celery.tasks': [
+            'oarepo_references = oarepo_references.tasks',
+        ],
         'flask.commands': [
             'references = oarepo_references.cli:references',
         ]
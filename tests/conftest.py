@@ -10,16 +10,19 @@
 See https://pytest-invenio.readthedocs.io/ for documentation on which test
 fixtures are available.
 """
+import json
 import os
+import threading
 import uuid
 
 import pytest
 from flask import url_for
 from invenio_app.factory import create_api
+from elasticsearch.serializer import JSONSerializer
 from invenio_db import db as _db
 from invenio_pidstore.providers.recordid import RecordIdProvider
 from sqlalchemy_utils import create_database, database_exists
-from tests.test_utils import TestRecord
+from tests.test_utils import NodeRecord, TestRecord
 from invenio_search import RecordsSearch
 
 from oarepo_references.api import RecordReferenceAPI
@@ -60,7 +63,8 @@ def app_config(app_config):
         SERVER_NAME='localhost',
         CELERY_ALWAYS_EAGER=True,
         CELERY_BROKER_URL='memory://localhost/',
-        CELERY_RESULT_BACKEND='rpc'
+        CELERY_RESULT_BACKEND='rpc',
+        INDEXER_REPLACE_REFS=False
     )
     app_config['PIDSTORE_RECID_FIELD'] = 'pid'
     app_config['RECORDS_REST_ENDPOINTS'] = dict(
@@ -86,6 +90,49 @@ def app_config(app_config):
     return app_config
 
 
+class SearchClientStub(object):
+    """Search client recording bulk requests instead of sending them."""
+
+    def __init__(self):
+        """Initialize the stub with no requests."""
+        self.transport = self
+        self.indices = self
+        self.serializer = JSONSerializer()
+        self.requests = []
+        self.documents = []
+        self.refreshed = []
+        self.error = None
+
+    def bulk(self, body, **kwargs):
+        """Record documents of a bulk request together with the thread sending it."""
+        if self.error is not None:
+            raise self.error
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        actions = lines[::2]
+        self.requests.append((threading.current_thread(),
+                              [action['index']['_id'] for action in actions]))
+        self.documents.extend(zip(actions, lines[1::2]))
+        return {
+            'errors': False,
+            'items': [{'index': {'_id': action['index']['_id'], 'status': 200}}
+                      for action in actions]
+        }
+
+    def refresh(self, index, **kwargs):
+        """Record a refreshed index."""
+        self.refreshed.append(index)
+
+
+@pytest.fixture
+def search_client(app):
+    """Replace the search client of the app by a stub recording bulk requests."""
+    search = app.extensions['invenio-search']
+    client = search._client
+    search._client = SearchClientStub()
+    yield search._client
+    search._client = client
+
+
 @pytest.fixture
 def db(app):
     """Returns fresh db."""
@@ -175,6 +222,24 @@ def referencing_records(db, referenced_records):
     return referencing_records
 
 
+@pytest.fixture
+def node_records(db):
+    """Create a diamond of node records, b and c inline a, d inlines b and c."""
+    def _create(title, *parents):
+        return NodeRecord.create({
+            'title': title,
+            'links': {'self': 'http://localhost/api/nodes/{}'.format(title)},
+            'parents': [{k: v for k, v in parent.items() if k != 'notes'} for parent in parents]
+        })
+
+    a = _create('a')
+    b = _create('b', a)
+    c = _create('c', a)
+    d = _create('d', b, c)
+    db.session.commit()
+    return [a, b, c, d]
+
+
 @pytest.fixture
 def test_record_data():
     """Returns a data for a test record."""
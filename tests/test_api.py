@@ -6,10 +6,17 @@
 # it under the terms of the MIT License; see LICENSE file for more details.
 
 """Test API class methods."""
+import json
+import threading
+import uuid
+
 import pytest
+from invenio_indexer.api import RecordIndexer
+from invenio_records.models import RecordMetadata
 from tests.conftest import get_pid, get_ref_url
 from tests.test_utils import TestRecord
 
+from oarepo_references.models import RecordReference, ReferencingRecord
 from oarepo_references.signals import after_reference_update
 
 
@@ -32,12 +39,52 @@ class TestOArepoReferencesAPI:
         with pytest.raises(AssertionError):
             references_api.reference_content_changed(ref)
 
+        # link-only referrers hold no inlined data to be updated
         updated = references_api.reference_content_changed(
             ref,
             ref_url='http://localhost/records/1',
             ref_uuid=ref.id
         )
-        assert len(updated) == 3
+        assert len(updated) == 0
+
+        taxo_url = test_record_data['taxo1']['links']['self']
+        updated = references_api.reference_content_changed(
+            {'links': {'self': taxo_url}, 'slug': 'b', 'title': 'change'},
+            ref_url=taxo_url
+        )
+        assert len(updated) == 1
+        assert updated[0]['taxo1']['title'] == 'change'
+
+        # unchanged content is not propagated again
+        updated = references_api.reference_content_changed(
+            {'links': {'self': taxo_url}, 'slug': 'b', 'title': 'change'},
+            ref_url=taxo_url
+        )
+        assert len(updated) == 0
+
+    def test_reference_content_changed_many(self, referencing_records,
+                                            test_record_data, references_api):
+        """Test that a record inlining several changed references is updated once."""
+        ruuid, pid = get_pid()
+        test_record_data['pid'] = pid
+        rec = TestRecord.create(test_record_data, id_=ruuid)
+        rec.commit()
+
+        taxo1_url = test_record_data['taxo1']['links']['self']
+        taxo2_url = test_record_data['sub']['taxo2']['links']['self']
+        updated = references_api.reference_content_changed_many([
+            {'content': {'links': {'self': taxo1_url}, 'slug': 'b', 'title': 'b changed'},
+             'url': taxo1_url},
+            {'content': {'links': {'self': taxo2_url}, 'slug': 'c', 'title': 'c changed'},
+             'url': taxo2_url},
+        ])
+        assert len(updated) == 1
+        assert updated[0]['taxo1']['title'] == 'b changed'
+        assert updated[0]['sub']['taxo2']['title'] == 'c changed'
+
+        assert references_api.reference_content_changed_many([]) == []
+        with pytest.raises(AssertionError):
+            references_api.reference_content_changed_many([{'content': {}}])
 
     def test_reference_changed(self, db, referencing_records,
                                referenced_records, references_api):
@@ -56,6 +103,59 @@ class TestOArepoReferencesAPI:
             refs.append(ref)
         assert refs == ['http://localhost/records/new', 'http://localhost/records/new']
 
+    def test_reference_changed_bulk(self, db, referencing_records, references_api):
+        """Test bulk rename of a reference prefix."""
+        updated = references_api.reference_changed(
+            old='http://localhost/records/',
+            new='http://localhost/api/records/',
+            bulk=True,
+            prefix=True
+        )
+        assert sorted(upd.id for upd in updated) == sorted(rr.id for rr in referencing_records)
+        assert all('http://localhost/records/' not in json.dumps(upd.dumps()) for upd in updated)
+
+        refs = [r.reference for r in RecordReference.query]
+        assert len(refs) == 5
+        assert all(ref.startswith('http://localhost/api/records/') for ref in refs)
+        assert references_api.rename_references('http://localhost/records/',
+                                                'http://localhost/api/records/',
+                                                prefix=True) == 0
+
+    def test_reference_changed_bulk_exact(self, db, referencing_records, references_api):
+        """Test bulk rename of a single reference."""
+        old = 'http://localhost/records/2'
+        updated = references_api.reference_changed(old=old, new='http://localhost/records/new',
+                                                   bulk=True)
+        assert sorted(upd['title'] for upd in updated) == ['d', 'e']
+        assert all(old not in json.dumps(upd.dumps()) for upd in updated)
+        assert RecordReference.query.filter_by(reference=old).count() == 0
+        assert RecordReference.query.filter_by(reference='http://localhost/records/new') \
+            .count() == 2
+
+    def test_reference_changed_bulk_duplicate(self, db, referencing_records, references_api):
+        """Test that a renamed reference is dropped if its record already has the new one."""
+        e = referencing_records[2]
+        updated = references_api.reference_changed(old='http://localhost/records/2',
+                                                   new='http://localhost/records/1',
+                                                   bulk=True)
+        assert sorted(upd['title'] for upd in updated) == ['d', 'e']
+        assert [ref['reference'] for ref in RecordReference.get_reference_specs(e.id)] == \
+            ['http://localhost/records/1']
+        assert RecordReference.query.filter_by(reference='http://localhost/records/2') \
+            .count() == 0
+
+    def test_reference_changed_bulk_inline(self, db, node_records, references_api):
+        """Test that inlined references are not renamed by the bulk rename."""
+        a = node_records[0]
+        assert references_api.rename_references(a.canonical_url, 'http://localhost/new') == 0
+        assert RecordReference.query.filter_by(reference=a.canonical_url).count() == 2
+
+    def test_reference_changed_prefix(self, references_api):
+        """Test that prefix renames require the bulk mode."""
+        with pytest.raises(ValueError):
+            references_api.reference_changed('http://localhost/records/',
+                                             'http://localhost/api/records/', prefix=True)
+
     def test_get_records(self, db, referencing_records, references_api):
         """Test that we can get reference records referencing a reference."""
         recs = list(references_api.get_records('http://localhost/records/1'))
@@ -77,11 +177,81 @@ class TestOArepoReferencesAPI:
         recs = list(references_api.get_records('http://localhost/records/', exact=True))
         assert len(recs) == 0
 
+        # wildcard characters in the prefix are matched literally
+        recs = list(references_api.get_records('http://localhost/records_'))
+        assert len(recs) == 0
+
+    def test_iter_records(self, db, referencing_records, references_api):
+        """Test that reference records are iterated in chunks."""
+        chunks = list(references_api.iter_records('http://localhost/records/', chunk_size=2))
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+
+        ids = [ref.id for chunk in chunks for ref in chunk]
+        assert ids == sorted(ids)
+        assert set(ids) == set(ref.id for ref in references_api.get_records(
+            'http://localhost/records/'))
+
+    def test_get_records_by_uuid(self, db, referenced_records, test_record_data,
+                                 references_api):
+        """Test that we can get reference records by a referenced record UUID."""
+        rec = TestRecord.create(test_record_data)
+        ref = referenced_records[0]
+        RecordReference.update_references(rec, [
+            dict(reference=get_ref_url(ref['pid']), reference_uuid=ref.id, inline=True)
+        ])
+        db.session.commit()
+
+        recs = references_api.get_records_by_uuid(ref.id)
+        assert [rc.record.record_uuid for rc in recs] == [rec.id]
+
+        rows = references_api.get_referrers(reference_uuids=[ref.id], inline=True)
+        assert [row.record_uuid for row in rows] == [rec.id]
+
+    def test_lock_referrers(self, db, referencing_records, references_api):
+        """Test that referrers are grouped by class and loaded once."""
+        referrers = references_api.get_referrer_ids_by_class(
+            'http://localhost/records/1', exact=True)
+        assert len(referrers) == 1
+        assert sorted(list(referrers.values())[0]) == \
+            sorted(rr.id for i, rr in enumerate(referencing_records) if i in [0, 2, 3])
+
+        locked = list(references_api.lock_referrers(referrers))
+        assert all(isinstance(rec, TestRecord) for rec in locked)
+        assert sorted(rec.id for rec in locked) == sorted(list(referrers.values())[0])
+
+    def test_update_references_from_records(self, db, referencing_records, references_api):
+        """Test that references of records are recomputed from their metadata."""
+        expected = sorted((r.reference, r.record.record_uuid) for r in RecordReference.query)
+        RecordReference.query.delete()
+        db.session.commit()
+
+        stats = references_api.update_references_from_records(
+            [rr.id for rr in referencing_records] + [uuid.uuid4()])
+        db.session.commit()
+        assert stats == {'updated': len(referencing_records), 'skipped': 1}
+        assert sorted((r.reference, r.record.record_uuid)
+                      for r in RecordReference.query) == expected
+
+    def test_delete_orphaned_references(self, db, referencing_records, references_api):
+        """Test that references of records deleted behind our back are removed."""
+        deleted = referencing_records[0]
+        # deleted without emitting record signals, as e.g. by a bulk import
+        db.session.query(RecordMetadata).filter_by(id=deleted.id) \
+            .update({RecordMetadata.json: None}, synchronize_session=False)
+        db.session.commit()
+
+        assert references_api.delete_orphaned_references() == 1
+        db.session.commit()
+        assert ReferencingRecord.query.filter_by(record_uuid=deleted.id).count() == 0
+        assert RecordReference.query.count() == 4
+        assert references_api.delete_orphaned_references() == 0
+
     def test_reindex_referencing_records(self,
                                          db,
                                          referenced_records,
                                          referencing_records,
-                                         references_api):
+                                         references_api,
+                                         search_client):
         def _test_handler(referrers):
             def _handler(_, references, ref_obj):
                 assert set(references) == set(referrers)
@@ -94,3 +264,81 @@ class TestOArepoReferencesAPI:
         after_reference_update.connect(handle)
 
         references_api.reindex_referencing_records(get_ref_url(referenced_records[0]['pid']))
+
+    def test_reindex_referencing_records_after_commit(self, db, referenced_records,
+                                                      referencing_records, references_api,
+                                                      search_client):
+        """Test that referrers of all changes in a transaction are reindexed once on commit."""
+        calls = []
+
+        def _handler(_, references, ref_obj):
+            calls.append(sorted(references))
+            return True
+
+        after_reference_update.connect(_handler)
+        try:
+            for ref in referenced_records:
+                references_api.reindex_referencing_records(get_ref_url(ref['pid']),
+                                                           after_commit=True)
+            assert calls == []
+            db.session.commit()
+            assert calls == [sorted(r.id for r in referencing_records)]
+
+            references_api.reindex_referencing_records(get_ref_url(referenced_records[0]['pid']),
+                                                       after_commit=True)
+            db.session.rollback()
+            db.session.commit()
+            assert len(calls) == 1
+        finally:
+            after_reference_update.disconnect(_handler)
+
+    def test_reindex_referencing_records_after_savepoint(self, db, referenced_records,
+                                                         referencing_records, references_api,
+                                                         search_client):
+        """Test that referrers collected in a released savepoint are dropped on rollback."""
+        with db.session.begin_nested():
+            references_api.reindex_referencing_records(get_ref_url(referenced_records[0]['pid']),
+                                                       after_commit=True)
+        db.session.rollback()
+        db.session.commit()
+        assert search_client.requests == []
+
+    def test_reindex_referencing_records_failure(self, db, referenced_records,
+                                                 referencing_records, references_api,
+                                                 search_client, caplog):
+        """Test that a failed reindex after commit is logged, not raised."""
+        search_client.error = ConnectionError('search is down')
+        references_api.reindex_referencing_records(get_ref_url(referenced_records[0]['pid']),
+                                                   after_commit=True)
+        db.session.commit()
+        assert 'reindexing of 3 records failed' in caplog.text
+
+    def test_bulk_reindex(self, app, db, referencing_records, references_api, search_client,
+                          monkeypatch):
+        """Test that chunks of records are indexed by bulk requests sent from threads."""
+        monkeypatch.setitem(app.config, 'OAREPO_REFERENCES_REINDEX_CHUNK_SIZE', 1)
+        monkeypatch.setitem(app.config, 'OAREPO_REFERENCES_REINDEX_CONCURRENCY', 2)
+        record_uuids = [r.id for r in referencing_records]
+
+        references_api.bulk_reindex(iter(record_uuids + [uuid.uuid4()]))
+        assert sorted(ids for _, ids in search_client.requests) == \
+            sorted([str(record_uuid)] for record_uuid in record_uuids)
+        assert all(thread is not threading.current_thread()
+                   for thread, _ in search_client.requests)
+        assert len(search_client.refreshed) == 1
+
+    def test_bulk_reindex_indexer(self, db, referencing_records, references_api, search_client):
+        """Test that documents are prepared by the indexer from records of their own class."""
+        class _Indexer(RecordIndexer):
+            def _prepare_record(self, record, index, doc_type, arguments=None, **kwargs):
+                data = super(_Indexer, self)._prepare_record(record, index, doc_type,
+                                                             arguments, **kwargs)
+                data['record_class'] = type(record).__name__
+                return data
+
+        references_api.bulk_reindex([r.id for r in referencing_records],
+                                    indexer=_Indexer(version_type='external'))
+        assert len(search_client.documents) == len(referencing_records)
+        for action, source in search_client.documents:
+            assert action['index']['version_type'] == 'external'
+            assert source['record_class'] == 'TestRecord'
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Miroslav Bauer, CESNET.
+#
+# oarepo-references is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License; see LICENSE file for more details.
+
+"""Test references CLI commands."""
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from invenio_db import db as _db
+from invenio_records.models import RecordMetadata
+
+from oarepo_references.cli import rename, synchronize
+from oarepo_references.models import RecordReference, ReferencingRecord
+
+
+def _references():
+    """Returns stored references as (reference, referencing record UUID) tuples."""
+    return sorted((r.reference, r.record.record_uuid) for r in RecordReference.query)
+
+
+def _synchronize(app, tmpdir, *args):
+    """Runs the synchronize command with checkpoint files in a temporary directory."""
+    result = app.test_cli_runner().invoke(synchronize, [
+        '--checkpoint', str(tmpdir.join('checkpoint.json')),
+        '--watermark', str(tmpdir.join('watermark.json')),
+        *args
+    ])
+    assert result.exit_code == 0, result.output
+    return result
+
+
+def _write_checkpoint(tmpdir, last_id, processed=1):
+    """Writes a checkpoint of a run interrupted after a record."""
+    with open(str(tmpdir.join('checkpoint.json')), 'w') as f:
+        json.dump({
+            'incremental': False,
+            'head': None,
+            'last': {'id': str(last_id), 'updated': '2020-01-01T00:00:00.000000'},
+            'processed': processed
+        }, f)
+
+
+def _clear_references():
+    """Removes stored references, keeping their referencing records."""
+    RecordReference.query.delete()
+    _db.session.commit()
+
+
+def test_synchronize(app, db, referencing_records, tmpdir):
+    """Test that references of all records are recomputed."""
+    expected = _references()
+    _clear_references()
+
+    result = _synchronize(app, tmpdir, '--chunk-size', '2')
+    assert 'Synchronized references of 4 records' in result.output
+    assert _references() == expected
+    assert not tmpdir.join('checkpoint.json').exists()
+    assert tmpdir.join('watermark.json').exists()
+
+
+def test_synchronize_resume(app, db, referencing_records, tmpdir):
+    """Test that an interrupted run resumes after the last checkpointed record."""
+    expected = _references()
+    referrers = sorted(r.id for r in referencing_records)
+    _clear_references()
+
+    _write_checkpoint(tmpdir, referrers[1], processed=2)
+    result = _synchronize(app, tmpdir)
+    assert 'Resuming after record {}'.format(referrers[1]) in result.output
+    assert _references() == [ref for ref in expected if ref[1] in referrers[2:]]
+    assert not tmpdir.join('checkpoint.json').exists()
+
+
+def test_synchronize_restart(app, db, referencing_records, tmpdir):
+    """Test that a checkpoint is ignored on restart."""
+    expected = _references()
+    referrers = sorted(r.id for r in referencing_records)
+    _clear_references()
+
+    _write_checkpoint(tmpdir, referrers[-1])
+    result = _synchronize(app, tmpdir, '--restart')
+    assert 'Resuming' not in result.output
+    assert _references() == expected
+
+
+def test_synchronize_workers(app, db, referencing_records, tmpdir):
+    """Test that chunks of records are processed by worker processes."""
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        pytest.skip('SQLite does not support concurrent writers')
+    expected = _references()
+    _clear_references()
+
+    _synchronize(app, tmpdir, '--workers', '2', '--chunk-size', '1')
+    assert _references() == expected
+    assert ReferencingRecord.query.count() == len({ref[1] for ref in expected})
+
+
+def test_synchronize_incremental(app, db, referencing_records, tmpdir):
+    """Test that an incremental run processes records updated since the watermark."""
+    expected = _references()
+    referrers = sorted(r.id for r in referencing_records)
+    _clear_references()
+
+    watermark = datetime(2020, 1, 1)
+    updated = {
+        referrers[0]: watermark - timedelta(days=1),
+        # saved by a transaction running at the start of the last run
+        referrers[1]: watermark - timedelta(seconds=10),
+        referrers[2]: watermark + timedelta(seconds=10),
+        referrers[3]: watermark - timedelta(hours=1),
+    }
+    for record_uuid, timestamp in updated.items():
+        _db.session.query(RecordMetadata).filter_by(id=record_uuid) \
+            .update({RecordMetadata.updated: timestamp}, synchronize_session=False)
+    _db.session.commit()
+    with open(str(tmpdir.join('watermark.json')), 'w') as f:
+        json.dump({'last': {'id': str(referrers[3]),
+                            'updated': watermark.strftime('%Y-%m-%dT%H:%M:%S.%f')}}, f)
+
+    _synchronize(app, tmpdir, '--incremental')
+    assert _references() == [ref for ref in expected if ref[1] in referrers[1:3]]
+    with open(str(tmpdir.join('watermark.json'))) as f:
+        assert json.load(f)['last']['updated'] >= \
+            updated[referrers[2]].strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+def _rename(app, tmpdir, *args):
+    """Runs the rename command with a checkpoint file in a temporary directory."""
+    result = app.test_cli_runner().invoke(rename, [
+        '--checkpoint', str(tmpdir.join('rename.json')),
+        *args
+    ])
+    assert result.exit_code == 0, result.output
+    return result
+
+
+def _stored_records():
+    """Returns JSON of all stored records serialized to strings, by their title."""
+    return {rm.json['title']: json.dumps(rm.json) for rm in RecordMetadata.query}
+
+
+def test_rename(app, db, referencing_records, tmpdir):
+    """Test that references are renamed and their referencing records rewritten."""
+    result = _rename(app, tmpdir, '--prefix', '--chunk-size', '2',
+                     'http://localhost/records/', 'http://localhost/api/records/')
+    assert 'Renamed references of 4 records' in result.output
+    assert all(ref.startswith('http://localhost/api/records/') for ref, _ in _references())
+    assert not any('http://localhost/records/' in data for data in _stored_records().values())
+    assert not tmpdir.join('rename.json').exists()
+
+
+def test_rename_resume(app, db, references_api, referencing_records, tmpdir):
+    """Test that an interrupted rename rewrites records after the checkpointed one."""
+    old, new = 'http://localhost/records/', 'http://localhost/api/records/'
+    assert references_api.rename_references(old, new, prefix=True) == 4
+    _db.session.commit()
+    record_ids = sorted({v for v, in _db.session.query(RecordReference.record_id)
+                         .filter(RecordReference.reference.startswith(new))})
+    with open(str(tmpdir.join('rename.json')), 'w') as f:
+        json.dump({'params': {'old': old, 'new': new, 'prefix': True},
+                   'last': record_ids[0], 'processed': 1}, f)
+
+    result = _rename(app, tmpdir, '--prefix', old, new)
+    assert 'Resuming after referencing record {}'.format(record_ids[0]) in result.output
+    first = ReferencingRecord.query.get(record_ids[0]).record_uuid
+    assert [title for title, data in _stored_records().items() if old in data] == \
+        [rm.json['title'] for rm in RecordMetadata.query.filter_by(id=first)]
+    assert not tmpdir.join('rename.json').exists()
@@ -7,7 +7,98 @@
 
 """Test OARepo references fields."""
 import pytest
-from tests.test_utils import TestRecord
+from flask import url_for
+from invenio_indexer.api import RecordIndexer
+from invenio_records import Record
+from invenio_records.models import RecordMetadata
+from marshmallow import INCLUDE, Schema
+from oarepo_validate import MarshmallowValidatedRecordMixin
+from tests.test_utils import NodeRecord, TestRecord
+
+from oarepo_references.mixins import CreateInlineRecordReferenceMixin, \
+    ReferenceEnabledRecordMixin
+from oarepo_references.models import RecordReference
+
+
+class KeywordRecordSchema(Schema):
+    """Schema of a keyword record."""
+
+    class Meta:
+        unknown = INCLUDE
+
+
+class KeywordRecord(MarshmallowValidatedRecordMixin,
+                    ReferenceEnabledRecordMixin,
+                    Record):
+    """Keyword record created when inlined by another record."""
+
+    MARSHMALLOW_SCHEMA = KeywordRecordSchema
+
+    @property
+    def canonical_url(self):
+        return url_for('invenio_records_rest.recid_item',
+                       pid_value=self['pid'], _external=True)
+
+
+class KeywordSchema(CreateInlineRecordReferenceMixin, Schema):
+    """Schema of an inlined keyword record created if it does not exist yet."""
+
+    class Meta:
+        unknown = INCLUDE
+
+    pid_type = 'recid'
+    record_class = KeywordRecord
+    create_in_batch = True
+
+    def ref_url(self, data):
+        return data.get('links', {}).get('self')
+
+    def postprocess_created_object_data(self, object_data):
+        return dict(object_data, links={
+            'self': 'http://localhost/api/records/{}'.format(object_data['pid'])
+        })
+
+
+class IndexedKeywordSchema(KeywordSchema):
+    """Schema of an inlined keyword record indexed in elasticsearch."""
+
+    index_name = 'records'
+    index_after_commit = True
+
+
+class DumpedKeywordRecord(KeywordRecord):
+    """Keyword record with its own dump."""
+
+    def dumps(self, **kwargs):
+        return dict(super().dumps(**kwargs), dumped_by=type(self).__name__)
+
+
+class KeywordIndexer(RecordIndexer):
+    """Indexer of keyword records with its own document preparation."""
+
+    def _prepare_record(self, record, index, doc_type, arguments=None, **kwargs):
+        data = super()._prepare_record(record, index, doc_type, arguments, **kwargs)
+        return dict(data, indexed_by=type(self).__name__)
+
+
+class CustomIndexedKeywordSchema(IndexedKeywordSchema):
+    """Schema of an inlined keyword record indexed by its own indexer."""
+
+    record_class = DumpedKeywordRecord
+    record_indexer = KeywordIndexer
+
+
+class UnlinkedKeywordSchema(KeywordSchema):
+    """Schema of an inlined keyword record whose inlined data do not link to it."""
+
+    def postprocess_created_object_data(self, object_data):
+        return object_data
+
+
+class DedupedKeywordSchema(KeywordSchema):
+    """Schema of an inlined keyword record created once for identical data."""
+
+    dedupe_created_objects = True
 
 
 @pytest.mark.usefixtures("db")
@@ -24,3 +115,83 @@ class TestOArepoMixins:
 
         rec.update_inlined_ref('http://localhost/api/taxonomies/requestors/a/b/', None, ref)
         assert rec['taxo1']['title'] == 'new title'
+
+    def test_patch_inlined_refs(self, referenced_records, test_record_data):
+        """Test replacing inlined reference content at its JSON path."""
+        rec = TestRecord.create(test_record_data)
+        url = 'http://localhost/api/taxonomies/requestors/a/c/'
+        ref = {'links': {'self': url}, 'slug': 'c', 'title': 'new title'}
+
+        rec.patch_inlined_refs([dict(url=url, uuid=None, content=ref, paths=['/sub/taxo2'])])
+        assert rec['sub']['taxo2']['title'] == 'new title'
+        assert rec['taxo1'] == test_record_data['taxo1']
+
+    def test_patch_inlined_refs_postprocess(self, node_records):
+        """Test that patched contents are processed by the inline reference schema."""
+        a, b, c, d = node_records
+        content = dict(a, title='A', notes='not inlined')
+
+        b.patch_inlined_refs([dict(url=a.canonical_url, uuid=None, content=content,
+                                   paths=['/parents/0'])])
+        assert b['parents'] == [{'title': 'A', 'links': a['links'], 'parents': []}]
+        assert [ref['content_digest'] for ref in RecordReference.get_reference_specs(b.id)] == \
+            [NodeRecord.inlined_content_digest('/parents/0', content)]
+
+    def test_create_inline_records_in_batch(self, db):
+        """Test that missing referenced records of a list are created at once."""
+        existing = {'title': 'c', 'links': {'self': 'http://localhost/api/records/999'}}
+        result = KeywordSchema(many=True).load([{'title': 'a'}, {'title': 'b'}, existing])
+
+        assert [item['title'] for item in result] == ['a', 'b', 'c']
+        assert result[2] == existing
+        created = Record.get_records([rm.id for rm in RecordMetadata.query])
+        assert sorted(rec['title'] for rec in created) == ['a', 'b']
+        assert sorted(item['links']['self'] for item in result[:2]) == sorted(
+            'http://localhost/api/records/{}'.format(rec['pid']) for rec in created)
+
+    def test_create_inline_records_in_batch_unlinked(self, db):
+        """Test that records created in a batch are not created again by per-item hooks."""
+        result = UnlinkedKeywordSchema(many=True).load([{'title': 'a'}, {'title': 'b'}])
+
+        assert [item['title'] for item in result] == ['a', 'b']
+        assert all(type(item) is dict for item in result)
+        assert RecordMetadata.query.count() == 2
+
+    def test_create_inline_records_index_after_commit(self, db, search_client):
+        """Test that created records are indexed once the transaction commits."""
+        IndexedKeywordSchema(many=True).load([{'title': 'a'}, {'title': 'b'}])
+        assert search_client.requests == []
+        db.session.commit()
+        assert [sorted(ids) for _, ids in search_client.requests] == \
+            [sorted(str(rm.id) for rm in RecordMetadata.query)]
+
+        IndexedKeywordSchema(many=True).load([{'title': 'c'}])
+        db.session.rollback()
+        db.session.commit()
+        assert len(search_client.requests) == 1
+
+    def test_create_inline_records_index_after_commit_indexer(self, db, search_client):
+        """Test that created records are indexed by the configured indexer and record class."""
+        CustomIndexedKeywordSchema(many=True).load([{'title': 'a'}, {'title': 'b'}])
+        db.session.commit()
+        assert sorted(source['title'] for _, source in search_client.documents) == ['a', 'b']
+        for _, source in search_client.documents:
+            assert source['dumped_by'] == 'DumpedKeywordRecord'
+            assert source['indexed_by'] == 'KeywordIndexer'
+
+    def test_create_inline_records_dedupe(self, db):
+        """Test that identical new objects create a single record within a transaction."""
+        result = DedupedKeywordSchema(many=True).load(
+            [{'title': 'a'}, {'title': 'a'}, {'title': 'b'}])
+        assert result[0] == result[1] != result[2]
+        assert DedupedKeywordSchema().load({'title': 'a'}) == result[0]
+        assert RecordMetadata.query.count() == 2
+
+        # records created in between release their savepoints
+        DedupedKeywordSchema().load({'title': 'c'})
+        assert DedupedKeywordSchema().load({'title': 'a'}) == result[0]
+        assert RecordMetadata.query.count() == 3
+
+        db.session.commit()
+        DedupedKeywordSchema().load({'title': 'a'})
+        assert RecordMetadata.query.count() == 4
@@ -15,7 +15,7 @@ from tests.conftest import get_ref_url
 from tests.test_utils import TestRecord
 
 from oarepo_references.models import ClassName, RecordReference, \
-    ReferencingRecord
+    ReferencingRecord, _insert_ignoring_conflicts
 from oarepo_references.utils import class_import_string
 
 
@@ -61,3 +61,126 @@ class TestReferencesModels:
         assert retrieved.reference == reference
         assert retrieved.reference_uuid == ref.id
         assert retrieved.inline is True
+
+    def test_reference_record_create_duplicate(self, db, test_record_data, referenced_records):
+        """Test that a duplicate reference is not stored twice."""
+        rec = TestRecord.create(test_record_data)
+        ref = referenced_records[0]
+        reference = get_ref_url(ref['pid'])
+
+        rr = RecordReference.create(rec, reference, ref.id, inline=True)
+        assert ReferencingRecord.get_or_create_id(rec) == rr.record_id
+        assert RecordReference.create(rec, reference, ref.id, raise_on_duplicit=False) is None
+        with pytest.raises(IntegrityError):
+            RecordReference.create(rec, reference, ref.id)
+        db.session.commit()
+
+        assert RecordReference.query.filter_by(reference=reference).count() == 1
+        assert ReferencingRecord.query.filter_by(record_uuid=rec.id).count() == 1
+
+    def test_update_references(self, db, test_record_data, referenced_records):
+        """Test bulk synchronization of record references."""
+        rec = TestRecord.create(test_record_data)
+        refs = [get_ref_url(r['pid']) for r in referenced_records]
+
+        RecordReference.update_references(rec, [
+            dict(reference=refs[0], reference_uuid=referenced_records[0].id, inline=True),
+            dict(reference=refs[1], reference_uuid=referenced_records[1].id, inline=False)
+        ])
+        db.session.commit()
+
+        rr = ReferencingRecord.query.filter_by(record_uuid=rec.id).one()
+        assert {r.reference: r.inline for r in rr.references} == {refs[0]: True, refs[1]: False}
+
+        RecordReference.update_references(rec, [
+            dict(reference=refs[1], reference_uuid=referenced_records[1].id, inline=False)
+        ])
+        db.session.commit()
+
+        rr = ReferencingRecord.query.filter_by(record_uuid=rec.id).one()
+        assert [r.reference for r in rr.references] == [refs[1]]
+
+        RecordReference.update_references(rec, [])
+        db.session.commit()
+        assert RecordReference.query.filter_by(record_id=rr.id).count() == 0
+
+    def test_update_references_inlined_and_linked(self, db, test_record_data,
+                                                  referenced_records):
+        """Test that a reference both inlined and linked keeps paths of the inlined content."""
+        ref = get_ref_url(referenced_records[0]['pid'])
+        rec = TestRecord.create(dict(test_record_data, taxo1={'links': {'self': ref}},
+                                     **{'$ref': ref}))
+        db.session.commit()
+
+        stored = RecordReference.query.filter_by(reference=ref).one()
+        assert stored.inline is True
+        assert stored.json_paths == ['/taxo1']
+        assert type(TestRecord.get_record(rec.id)['$ref']) is str
+
+        RecordReference.update_references(rec, [
+            dict(reference=ref, inline=False, json_paths=['/$ref']),
+            dict(reference=ref, inline=True, json_paths=['/taxo1']),
+            dict(reference=ref, inline=True, json_paths=['/sub/taxo2'])
+        ])
+        stored = RecordReference.query.filter_by(reference=ref).one()
+        assert stored.inline is True
+        assert stored.json_paths == ['/sub/taxo2', '/taxo1']
+
+    def test_update_references_loaded(self, db, test_record_data, referenced_records):
+        """Test that references loaded by the ORM are not stale after a bulk update."""
+        rec = TestRecord.create(test_record_data)
+        refs = [get_ref_url(r['pid']) for r in referenced_records]
+        RecordReference.update_references(rec, [
+            dict(reference=refs[0], inline=True, content_digest='a'),
+            dict(reference=refs[1], inline=True, content_digest='a')
+        ])
+        db.session.commit()
+
+        loaded = {r.reference: r for r in RecordReference.query.filter(
+            RecordReference.reference.in_(refs))}
+        RecordReference.update_references(rec, [
+            dict(reference=refs[0], inline=True, content_digest='b')
+        ])
+        assert loaded[refs[0]].content_digest == 'b'
+        loaded[refs[0]].inline = False
+        db.session.commit()
+        assert RecordReference.query.filter_by(reference=refs[0]).one().inline is False
+        assert RecordReference.query.filter_by(reference=refs[1]).count() == 0
+
+    def test_class_name_cache(self, db, referencing_records):
+        """Test that ClassName ids are cached and rolled back ids are not."""
+        name = str(class_import_string(referencing_records[0]))
+        cn = ClassName.query.filter_by(name=name).one()
+        assert ClassName.get_id(name) == cn.id
+        assert ClassName.get_name(cn.id) == name
+
+        ClassName.query.filter_by(id=cn.id).delete()
+        assert ClassName.get_id(name) == cn.id
+        db.session.rollback()
+
+        ClassName.get_id('tests.Unknown')
+        db.session.rollback()
+        assert ClassName.query.filter_by(name='tests.Unknown').count() == 0
+
+        new_id = ClassName.get_id('tests.Unknown')
+        assert ClassName.query.get(new_id).name == 'tests.Unknown'
+
+        # not cached when created in a savepoint of a rolled back transaction
+        with db.session.begin_nested():
+            ClassName.get_id('tests.Nested')
+        db.session.rollback()
+        assert ClassName.query.filter_by(name='tests.Nested').count() == 0
+        nested_id = ClassName.get_id('tests.Nested')
+        assert ClassName.query.get(nested_id).name == 'tests.Nested'
+
+    def test_insert_ignoring_conflicts(self, db):
+        """Test that only rows violating the unique constraint are skipped."""
+        table = ClassName.__table__
+        _insert_ignoring_conflicts(table, [dict(name='tests.A'), dict(name='tests.B')], ['name'])
+        _insert_ignoring_conflicts(table, [dict(name='tests.B'), dict(name='tests.C')], ['name'])
+        assert sorted(name for name, in db.session.query(ClassName.name)) == \
+            ['tests.A', 'tests.B', 'tests.C']
+
+        with pytest.raises(IntegrityError):
+            with db.session.begin_nested():
+                _insert_ignoring_conflicts(table, dict(name='tests.D', created=None), ['name'])
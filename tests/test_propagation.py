@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Miroslav Bauer, CESNET.
+#
+# oarepo-references is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License; see LICENSE file for more details.
+
+"""Test reference content propagation."""
+from flask import g
+from invenio_records.signals import after_record_update
+from sqlalchemy import event
+from tests.test_utils import NodeRecord
+
+from oarepo_references.propagation import ReferencePropagation
+from oarepo_references.proxies import current_references
+
+
+def _propagation(graph, origins=('a',)):
+    """Returns a propagation with a prepared graph of referrers."""
+    prop = ReferencePropagation(None, [
+        {'content': {}, 'url': f'http://localhost/records/{origin}'} for origin in origins
+    ])
+    nodes = dict(zip(origins, prop.origins))
+    for node, referrers in graph.items():
+        prop.referrers[nodes.get(node, node)] = list(referrers)
+        prop.visited.update(referrers)
+    return prop
+
+
+def test_order_diamond():
+    """Test that a record inlining two changed records is ordered after both."""
+    prop = _propagation({'a': ['b', 'c'], 'b': ['d'], 'c': ['d']})
+    order, back_edges = prop.order()
+
+    assert sorted(order) == ['b', 'c', 'd']
+    assert order[-1] == 'd'
+    assert back_edges == set()
+
+
+def test_order_cycle():
+    """Test that reference cycles are detected and not followed."""
+    prop = _propagation({'a': ['b'], 'b': ['c'], 'c': ['b']})
+    order, back_edges = prop.order()
+
+    assert order == ['b', 'c']
+    assert back_edges == {('c', 'b')}
+
+
+def test_order_many_origins():
+    """Test that a record inlining several changed references is ordered once, last."""
+    prop = _propagation({'a': ['c'], 'b': ['c', 'd'], 'd': ['c']}, origins=('a', 'b'))
+    order, back_edges = prop.order()
+
+    assert order == ['d', 'c']
+    assert back_edges == set()
+
+
+def _inlined_titles(rec):
+    """Returns titles of the parents and grandparents inlined into a node record."""
+    rec = NodeRecord.get_record(rec.id)
+    return [(parent['title'], [p['title'] for p in parent['parents']])
+            for parent in rec['parents']]
+
+
+def test_propagate_diamond(db, node_records):
+    """Test that a record inlining a changed record twice is committed once with both changes."""
+    a, b, c, d = node_records
+    committed = []
+
+    def _committed(sender, record, **kwargs):
+        committed.append(record['title'])
+
+    after_record_update.connect(_committed)
+    try:
+        a['title'] = 'A'
+        a.commit()
+    finally:
+        after_record_update.disconnect(_committed)
+    db.session.commit()
+
+    assert sorted(committed) == ['A', 'b', 'c', 'd']
+    assert committed.index('d') > max(committed.index('b'), committed.index('c'))
+    assert _inlined_titles(b) == [('A', [])]
+    assert _inlined_titles(c) == [('A', [])]
+    assert _inlined_titles(d) == [('b', ['A']), ('c', ['A'])]
+
+
+def test_propagate_in_chunks(app, db, node_records, monkeypatch):
+    """Test that referrers are looked up and updated chunk by chunk, each chunk committed."""
+    monkeypatch.setitem(app.config, 'OAREPO_REFERENCES_CHUNK_SIZE', 1)
+    monkeypatch.setitem(app.config, 'OAREPO_REFERENCES_LOCK_CHUNK_SIZE', 1)
+    a, b, c, d = node_records
+    commits = []
+
+    def _committed(session):
+        if session.transaction.parent is None:
+            commits.append(session)
+
+    event.listen(db.session, 'after_commit', _committed)
+    try:
+        updated = current_references.reference_content_changed(
+            dict(a, title='A'), a.canonical_url, commit=True)
+    finally:
+        event.remove(db.session, 'after_commit', _committed)
+
+    assert len(commits) == 3
+    assert sorted(updated) == sorted([b.id, c.id, d.id])
+    assert updated[-1] == d.id
+    assert _inlined_titles(d) == [('b', ['A']), ('c', ['A'])]
+
+
+def test_propagate_max_depth(db, node_records):
+    """Test that records farther from the changed reference than max_depth are not updated."""
+    a, b, c, d = node_records
+    updated = current_references.reference_content_changed(
+        dict(a, title='A'), a.canonical_url, max_depth=1)
+    db.session.commit()
+
+    assert sorted(rec['title'] for rec in updated) == ['b', 'c']
+    assert _inlined_titles(b) == [('A', [])]
+    assert _inlined_titles(d) == [('b', ['a']), ('c', ['a'])]
+
+
+def test_propagate_suppressed_while_propagating(db, node_records):
+    """Test that a record committed by a running propagation does not start another one."""
+    a, b, c, d = node_records
+    g.oarepo_references_propagating = True
+    try:
+        a['title'] = 'A'
+        a.commit()
+    finally:
+        g.oarepo_references_propagating = False
+    db.session.commit()
+
+    assert _inlined_titles(b) == [('a', [])]
+    assert _inlined_titles(c) == [('a', [])]
+
+
+def test_propagate_unchanged_inlined_content(db, node_records):
+    """Test that a change of content not inlined by the referrers is not propagated."""
+    a, b, c, d = node_records
+    assert current_references.reference_content_changed(
+        dict(a, notes='not inlined'), a.canonical_url) == []
+
+    updated = current_references.reference_content_changed(
+        dict(a, notes='not inlined', title='A'), a.canonical_url)
+    assert sorted(rec['title'] for rec in updated) == ['b', 'c', 'd']
+
+
+def test_propagate_duplicate_changes(db, node_records):
+    """Test that repeated changes of a reference are propagated once, the last one wins."""
+    a, b, c, d = node_records
+    updated = current_references.reference_content_changed_many([
+        dict(content=dict(a, title='A'), url=a.canonical_url),
+        dict(content=dict(a, title='AA'), url=a.canonical_url),
+    ])
+    db.session.commit()
+
+    assert sorted(rec['title'] for rec in updated) == ['b', 'c', 'd']
+    assert _inlined_titles(b) == [('AA', [])]
+    assert _inlined_titles(d) == [('b', ['AA']), ('c', ['AA'])]
+
+
+def test_propagate_duplicate_changes_revision(db, node_records):
+    """Test that the change of the highest revision of a record wins."""
+    a, b, c, d = node_records
+    a['title'] = 'A'
+    a.commit()
+    stale = a.revisions[a.revision_id - 1]
+    assert stale.revision_id < a.revision_id
+    current_references.reference_content_changed_many([
+        dict(content=a, url=a.canonical_url),
+        dict(content=stale, url=a.canonical_url),
+    ])
+    db.session.commit()
+
+    assert _inlined_titles(b) == [('A', [])]
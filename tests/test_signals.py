@@ -10,7 +10,7 @@ import pytest
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 from tests.conftest import get_pid
-from tests.test_utils import TaxonomyRecord, TestRecord
+from tests.test_utils import NodeRecord, TaxonomyRecord, TestRecord
 
 from oarepo_references.models import RecordReference, ReferencingRecord
 from oarepo_references.proxies import current_references
@@ -128,3 +128,73 @@ def test_delete_references_record(referencing_records):
 
     refs = RecordReference.query.filter(RecordReference.record_id == rr.id).all()
     assert len(refs) == 0
+
+
+def test_update_references_record_async(app, db, monkeypatch, node_records):
+    """Test that a deferred propagation is queued on commit and skips outdated revisions."""
+    from oarepo_references import tasks
+    propagate_reference_content = tasks.propagate_reference_content
+    queued = []
+
+    class _QueuedTask(object):
+        def apply_async(self, kwargs, countdown=None):
+            queued.append(kwargs)
+
+    monkeypatch.setattr(tasks, 'propagate_reference_content', _QueuedTask())
+    monkeypatch.setitem(app.config, 'OAREPO_REFERENCES_PROPAGATION_ASYNC', True)
+    a, b, c, d = node_records
+
+    a['title'] = 'first'
+    a.commit()
+    a['title'] = 'second'
+    a.commit()
+    assert queued == []
+    db.session.commit()
+    # a single task for the latest revision, referrers are updated by the task only
+    assert [kwargs['revision_id'] for kwargs in queued] == [a.revision_id]
+    assert NodeRecord.get_record(b.id)['parents'][0]['title'] == 'a'
+
+    a['title'] = 'third'
+    a.commit()
+    db.session.rollback()
+    db.session.commit()
+    assert len(queued) == 1
+
+    propagate_reference_content.apply(kwargs=dict(queued[0],
+                                                  revision_id=a.revision_id - 1))
+    assert NodeRecord.get_record(b.id)['parents'][0]['title'] == 'a'
+
+    propagate_reference_content.apply(kwargs=queued[0])
+    assert NodeRecord.get_record(b.id)['parents'][0]['title'] == 'second'
+    assert NodeRecord.get_record(d.id)['parents'][1]['parents'][0]['title'] == 'second'
+
+
+def test_update_references_record_async_savepoint(app, db, monkeypatch, node_records):
+    """Test that a rolled back savepoint keeps propagations scheduled before it."""
+    from oarepo_references import tasks
+    queued = []
+
+    class _QueuedTask(object):
+        def apply_async(self, kwargs, countdown=None):
+            queued.append(kwargs)
+
+    monkeypatch.setattr(tasks, 'propagate_reference_content', _QueuedTask())
+    monkeypatch.setitem(app.config, 'OAREPO_REFERENCES_PROPAGATION_ASYNC', True)
+    a, b, c, d = node_records
+
+    a['title'] = 'first'
+    a.commit()
+    revision_id = a.revision_id
+    try:
+        with db.session.begin_nested():
+            a['title'] = 'second'
+            a.commit()
+            b['title'] = 'second'
+            b.commit()
+            raise ValueError()
+    except ValueError:
+        pass
+    db.session.commit()
+    # the propagation of the change made before the savepoint is still queued
+    assert [(kwargs['record_uuid'], kwargs['revision_id']) for kwargs in queued] == \
+        [(str(a.id), revision_id)]
@@ -10,15 +10,20 @@
 import pytest
 from celery import shared_task
 from flask import url_for
+from invenio_pidstore import current_pidstore
+from invenio_pidstore.models import PersistentIdentifier
 from invenio_records import Record
 from invenio_records_rest.schemas.fields import SanitizedUnicode
 from marshmallow import INCLUDE, Schema
-from marshmallow.fields import URL, Integer, Nested
+from marshmallow.fields import URL, Dict, Integer, Nested
 from oarepo_validate import MarshmallowValidatedRecordMixin
 
 from oarepo_references.mixins import InlineReferenceMixin, \
     ReferenceByLinkFieldMixin, ReferenceEnabledRecordMixin
-from oarepo_references.utils import get_reference_uuid, run_task_on_referrers
+from oarepo_references.proxies import current_references
+from oarepo_references.utils import TransactionState, build_endpoint_index, \
+    get_reference_uuid, get_reference_uuids, reference_uuid_cache, \
+    resolve_reference_paths, run_task_on_referrers
 
 
 class URLReferenceField(ReferenceByLinkFieldMixin, URL):
@@ -84,6 +89,44 @@ class TaxonomyRecord(MarshmallowValidatedRecordMixin,
                        pid_value=self['pid'], _external=True)
 
 
+class InlinedNodeSchema(InlineReferenceMixin, Schema):
+    """Schema of a node record inlined into another node, without its notes."""
+
+    class Meta:
+        unknown = INCLUDE
+
+    def ref_url(self, data):
+        return data['links']['self']
+
+    def postprocess_inline_reference_data(self, data):
+        return {k: v for k, v in data.items() if k != 'notes'}
+
+
+class NodeSchema(Schema):
+    """Schema of a node record inlining its parent nodes."""
+
+    class Meta:
+        unknown = INCLUDE
+
+    title = SanitizedUnicode()
+    notes = SanitizedUnicode()
+    links = Dict()
+    parents = Nested(InlinedNodeSchema, many=True, required=False)
+
+
+class NodeRecord(MarshmallowValidatedRecordMixin,
+                 ReferenceEnabledRecordMixin,
+                 Record):
+    """Record for testing propagation through inlining records."""
+    MARSHMALLOW_SCHEMA = NodeSchema
+    VALIDATE_MARSHMALLOW = True
+    VALIDATE_PATCH = True
+
+    @property
+    def canonical_url(self):
+        return self['links']['self']
+
+
 @pytest.mark.celery()
 def test_run_task_on_referrers(referencing_records,
                                referenced_records):
@@ -98,13 +141,13 @@ def test_run_task_on_referrers(referencing_records,
 
     @shared_task
     def _test_success_task(*args, **kwargs):
-        assert kwargs['records'] == referers
+        assert sorted(r['pid'] for r in kwargs['records']) == sorted(r['pid'] for r in referers)
         nonlocal success
         success = True
 
     @shared_task
     def _test_error_task(*args, **kwargs):
-        assert kwargs['record'] == referencing_records[0]
+        assert kwargs['record']['pid'] in [r['pid'] for r in referers]
         nonlocal success
         success = False
 
@@ -121,7 +164,7 @@ def test_run_task_on_referrers(referencing_records,
     ret.get()
     print(ret.status, ret)
     assert len(tasklist) == 3
-    assert tasklist == referers
+    assert sorted(r['pid'] for r in tasklist) == sorted(r['pid'] for r in referers)
     assert success is True
 
     try:
@@ -134,6 +177,31 @@ def test_run_task_on_referrers(referencing_records,
     assert success is False
 
 
+@pytest.mark.celery()
+def test_run_task_on_referrers_ids_only(referencing_records, referenced_records):
+    """Test that tasks are launched in groups with UUIDs of referring records."""
+    referred = 'http://localhost/records/1'
+    referers = sorted(str(referencing_records[i].id) for i in [0, 2, 3])
+    tasklist = []
+    succeeded = []
+
+    @shared_task
+    def _test_ids_success_task(*args, **kwargs):
+        assert not args
+        succeeded.append((kwargs['reference'], sorted(kwargs['record_uuids'])))
+
+    @shared_task
+    def _test_ids_task(*args, **kwargs):
+        assert not args
+        tasklist.append(kwargs['record_uuid'])
+
+    ret = run_task_on_referrers(referred, _test_ids_task.s(), _test_ids_success_task.s(),
+                                ids_only=True, chunk_size=2)
+    ret.get()
+    assert sorted(tasklist) == referers
+    assert succeeded == [(referred, referers)]
+
+
 def test_get_reference_uuid(referencing_records, referenced_records):
     """Test that methods returns a valid UUID for a given reference URL."""
 
@@ -151,3 +219,159 @@ def test_get_reference_uuid(referencing_records, referenced_records):
     assert reference is None
     reference = get_reference_uuid('hhtp//localhost/api/records/1')
     assert reference is None
+
+
+def test_get_reference_uuids(referenced_records):
+    """Test that UUIDs of many reference URLs are resolved at once."""
+    urls = ['http://localhost/api/records/{}'.format(rec['pid']) for rec in referenced_records]
+    uuids = get_reference_uuids(urls + [
+        'http://localhost/api/records/10',
+        'http://otherhost/api/records/1',
+        None
+    ])
+    assert uuids == {url: rec.id for url, rec in zip(urls, referenced_records)}
+
+
+def test_get_reference_uuids_redirected(db, referenced_records):
+    """Test that redirected PIDs are followed by both single and bulk resolution."""
+    a, b = referenced_records
+    target = PersistentIdentifier.get('recid', b['pid'])
+    PersistentIdentifier.get('recid', a['pid']).redirect(target)
+    db.session.commit()
+    url = 'http://localhost/api/records/{}'.format(a['pid'])
+
+    assert get_reference_uuids([url]) == {url: b.id}
+    assert get_reference_uuid(url) == b.id
+    # not cached, the redirect might change
+    assert reference_uuid_cache.get(url) is None
+
+    target.delete()
+    db.session.commit()
+    assert get_reference_uuids([url]) == {}
+    assert get_reference_uuid(url) is None
+
+
+def test_build_endpoint_index(app):
+    """Test that endpoints are indexed by a PID type, default prefixes first."""
+    index = build_endpoint_index({
+        'recid_alt': dict(pid_type='recid', record_class='invenio_records.api:Record',
+                          index_name='alt'),
+        'recid': dict(pid_type='recid', default_endpoint_prefix=True, pid_minter='recid',
+                      index_name='records'),
+        'docid': dict(pid_type='docid'),
+    })
+    assert [name for name, _ in index['recid']] == ['recid', 'recid_alt']
+    assert [name for name, _ in index['docid']] == ['docid']
+    # configured values are kept as they are, endpoint_prop resolves them on first use
+    assert index['recid'][1][1]['record_class'] == 'invenio_records.api:Record'
+
+
+def test_endpoint_prop(db):
+    """Test that minters and classes of endpoints are resolved once and cached."""
+    name, endpoint = current_references.endpoints['recid'][0]
+    minter = current_references.endpoint_prop(name, endpoint, 'pid_minter')
+    assert minter is current_pidstore.minters['recid']
+    assert current_references._endpoint_props[(name, 'pid_minter')] is minter
+
+    endpoint = dict(endpoint, record_class='invenio_records.api:Record')
+    assert current_references.endpoint_prop('other', endpoint, 'record_class') is Record
+    assert current_references.endpoint_prop('other', endpoint, 'list_route') == '/records/'
+
+
+def test_get_reference_uuid_cache(db, referenced_records):
+    """Test that resolved UUIDs are cached until their PID changes."""
+    ref = referenced_records[0]
+    ref_url = 'http://localhost/api/records/{}'.format(ref['pid'])
+    assert get_reference_uuid(ref_url) == ref.id
+    assert reference_uuid_cache.get(ref_url)[2] == ref.id
+
+    # not cached for other transactions until committed
+    db.session.rollback()
+    assert reference_uuid_cache.get(ref_url) is None
+    assert get_reference_uuid(ref_url) == ref.id
+    db.session.commit()
+    assert reference_uuid_cache.get(ref_url)[2] == ref.id
+
+    PersistentIdentifier.get('recid', ref['pid']).delete()
+    db.session.commit()
+    assert reference_uuid_cache.get(ref_url) is None
+    assert get_reference_uuid(ref_url) is None
+
+
+def test_get_reference_uuid_cache_ttl(db, referenced_records, monkeypatch):
+    """Test that resolved UUIDs expire and are cached only once the transaction commits."""
+    ref = referenced_records[0]
+    ref_url = 'http://localhost/api/records/{}'.format(ref['pid'])
+    db.session.commit()
+
+    with db.session.begin_nested():
+        assert get_reference_uuid(ref_url) == ref.id
+    db.session.rollback()
+    assert reference_uuid_cache.get(ref_url) is None
+
+    monkeypatch.setattr(reference_uuid_cache, 'ttl', 0)
+    assert get_reference_uuid(ref_url) == ref.id
+    db.session.commit()
+    assert reference_uuid_cache.get(ref_url) is None
+
+
+def test_transaction_state(db):
+    """Test that entries are passed on once the outermost transaction commits."""
+    committed = []
+    state = TransactionState('test_transaction_state',
+                             lambda session, entries: committed.append(dict(entries)))
+
+    state['a'] = 1
+    with db.session.begin_nested():
+        state['b'] = 1
+        state['a'] = 2
+    try:
+        with db.session.begin_nested():
+            state['a'] = 3
+            state['c'] = 1
+            assert state.get('a') == 3
+            raise ValueError()
+    except ValueError:
+        pass
+    # entries of the rolled back savepoint are dropped, the earlier ones are kept
+    assert state.get('a') == 2
+    assert 'c' not in state
+    assert committed == []
+    db.session.commit()
+    assert committed == [{'a': 2, 'b': 1}]
+
+    state['d'] = 1
+    db.session.rollback()
+    db.session.commit()
+    assert committed == [{'a': 2, 'b': 1}]
+    assert 'd' not in state
+
+
+def test_resolve_reference_paths(test_record_data):
+    """Test that JSON paths of registered references are resolved."""
+    schema = TestSchema(context={'references': []})
+    data = dict(test_record_data, reflist=[{'$ref': 'http://localhost/records/1'}])
+    result = schema.load(data)
+
+    references = schema.context['references']
+    resolve_reference_paths(result, references)
+    paths = {ref['reference']: ref['json_paths'] for ref in references}
+    assert paths == {
+        'http://localhost/api/taxonomies/requestors/a/b/': ['/taxo1'],
+        'http://localhost/api/taxonomies/requestors/a/c/': ['/sub/taxo2'],
+        'http://localhost/records/1': ['/reflist/0/$ref'],
+    }
+    assert type(result['reflist'][0]['$ref']) is str
+
+
+def test_resolve_reference_paths_inlined_and_linked(test_record_data):
+    """Test that paths of a link are recorded only on positions of its link field."""
+    url = test_record_data['taxo1']['links']['self']
+    schema = TestSchema(context={'references': []})
+    result = schema.load(dict(test_record_data, **{'$ref': url}))
+
+    references = schema.context['references']
+    resolve_reference_paths(result, references)
+    paths = [(ref['inline'], ref['json_paths']) for ref in references
+             if ref['reference'] == url]
+    assert sorted(paths) == [(False, ['/$ref']), (True, ['/taxo1'])]